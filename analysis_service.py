@@ -0,0 +1,333 @@
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from results_writer import dumps_json, get_company_summary_record
+from spatial_index import MetroLookup, SpatialGridIndex
+
+logger = logging.getLogger(__name__)
+
+# largest radius in miles /interferences answers, a query is meant to look around one site
+MAX_QUERY_RADIUS_MI = 500
+
+
+class ServiceSnapshot:
+    """
+        everything the queries read, built once per load of the inputs: the site arrays, one spatial
+        index over the existing sites of every company, the metro lookup and the totals of the
+        analysis. A snapshot is never changed after it is built, a reload builds a new one and swaps
+        it in while the requests in flight keep reading the old one
+    """
+
+    def __init__(self,
+                 metro_coords_dict,
+                 company_site_arrays,
+                 all_company_analysis_results,
+                 build_threshold=1,
+                 city_threshold=30):
+        self.metro_lookup = MetroLookup(metro_coords_dict)
+        self.company_site_arrays = company_site_arrays
+        self.existing_indexes = {
+            company: SpatialGridIndex(site_arrays['existing_lats'], site_arrays['existing_lons'], cell_size_mi=build_threshold)
+            for company, site_arrays in company_site_arrays.items()
+        }
+        self.company_summaries = {
+            company: get_company_summary_record(company, company_results)
+            for company, company_results in all_company_analysis_results.items()
+        }
+        self.build_threshold = build_threshold
+        self.city_threshold = city_threshold
+        self.source_stats = None
+        self.loaded_at = time.time()
+
+    def get_companies(self):
+        return {
+            company: {
+                'construction_sites': len(site_arrays['construction_lats']),
+                'existing_sites': len(site_arrays['existing_lats'])
+            }
+            for company, site_arrays in self.company_site_arrays.items()
+        }
+
+    def query_site(self, lat, lon, radius_mi, companies, distance_mode='geodesic'):
+        """
+            the existing sites of 'companies' within 'radius_mi' of a proposed site at (lat, lon).
+            Like the analysis, every pair gets the metro closest to the midpoint of the two sites and
+            is counted when that metro is within city_threshold and the sites within build_threshold
+        """
+        interferences = []
+        for company in companies:
+            site_arrays = self.company_site_arrays[company]
+            existing_idxs, distances = self.existing_indexes[company].query_radius(lat, lon, radius_mi, distance_mode=distance_mode)
+            existing_lats = site_arrays['existing_lats'][existing_idxs]
+            existing_lons = site_arrays['existing_lons'][existing_idxs]
+
+            city_dists, city_ids = self.metro_lookup.nearest_ids((lat + existing_lats) / 2, (lon + existing_lons) / 2, distance_mode=distance_mode)
+            counted = (city_dists <= self.city_threshold) & (distances <= self.build_threshold)
+
+            for e_lat, e_lon, distance, city_id, city_dist, is_counted in zip(
+                    existing_lats.tolist(),
+                    existing_lons.tolist(),
+                    distances.tolist(),
+                    city_ids.tolist(),
+                    city_dists.tolist(),
+                    counted.tolist()):
+                interferences.append({
+                    'company': company,
+                    'existing_lat': e_lat,
+                    'existing_lon': e_lon,
+                    'distance': distance,
+                    'city': self.metro_lookup.cities[city_id],
+                    'city_distance': city_dist,
+                    'counted': is_counted
+                })
+
+        return {
+            'lat': lat,
+            'lon': lon,
+            'radius': radius_mi,
+            'total_interferences': len(interferences),
+            'total_counted': sum(interference['counted'] for interference in interferences),
+            'interferences': interferences
+        }
+
+
+class AnalysisService:
+    """
+        keeps the snapshot of the inputs warm for the http handler and rebuilds it when the files in
+        'watch_paths' change. 'load_snapshot' is called without arguments and returns a new
+        ServiceSnapshot, it is only ever called by one thread at a time
+
+        a snapshot that fails to load (e.g. a workbook that is still being written) is logged and
+        the previous snapshot keeps being served until the files change again
+    """
+
+    def __init__(self, load_snapshot, watch_paths, distance_mode='geodesic', reload_interval=2.0):
+        self.load_snapshot = load_snapshot
+        self.watch_paths = list(watch_paths)
+        self.distance_mode = distance_mode
+        self.reload_interval = reload_interval
+        self.snapshot = None
+        self._failed_stats = None
+        self._reload_lock = threading.Lock()
+
+    def get_source_stats(self):
+        """
+            modification time and size of every watched file, None for a missing file
+        """
+        source_stats = {}
+        for path in self.watch_paths:
+            try:
+                stat = os.stat(path)
+                source_stats[path] = [stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                source_stats[path] = None
+
+        return source_stats
+
+    def reload(self):
+        """
+            load the inputs and swap in the new snapshot
+        """
+        with self._reload_lock:
+            # read before loading, so a file changed during the load triggers another reload
+            source_stats = self.get_source_stats()
+
+            start = time.perf_counter()
+            snapshot = self.load_snapshot()
+            snapshot.source_stats = source_stats
+            self.snapshot = snapshot
+            self._failed_stats = None
+
+            logger.info(f"loaded {len(snapshot.company_site_arrays)} companies in {time.perf_counter() - start:.2f} s")
+
+        return snapshot
+
+    def reload_if_changed(self):
+        source_stats = self.get_source_stats()
+        if source_stats == self.snapshot.source_stats or source_stats == self._failed_stats:
+            return False
+
+        logger.info("inputs changed, reloading")
+        try:
+            self.reload()
+        except Exception:
+            self._failed_stats = source_stats
+            logger.exception("reload failed, still serving the previous inputs")
+            return False
+
+        return True
+
+    def watch(self, stop_event):
+        while not stop_event.wait(self.reload_interval):
+            self.reload_if_changed()
+
+
+def get_float_param(params, name, default=None, low=-math.inf, high=math.inf):
+    """
+        the first value of the query parameter 'name' as a float within [low, high], 'default'
+        when it is not given. Raises ValueError (answered with a 400) for a missing or invalid value
+    """
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise ValueError(f"missing parameter '{name}'")
+        return default
+
+    value = float(values[0])
+    if not math.isfinite(value) or not low <= value <= high:
+        raise ValueError(f"parameter '{name}' must be a number between {low} and {high}")
+
+    return value
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    """
+        json api over the snapshot of an AnalysisService (set as the 'service' class attribute)
+
+        GET  /health                                     when the inputs were loaded
+        GET  /companies                                  number of sites per company
+        GET  /summary?company=Z                          totals of the analysis per company
+        GET  /units_wip?company=Z&city=Y                 units in progress by city
+        GET  /interferences?lat=..&lon=..&radius=X&company=Z
+                                                         existing sites within X miles (default
+                                                         build_threshold, at most
+                                                         MAX_QUERY_RADIUS_MI) of a proposed site,
+                                                         the metro of each pair and whether the
+                                                         analysis counts it
+        POST /reload                                     reload the inputs now
+
+        company and city can be repeated and default to all of them
+
+        the distances of the queries are not cached, the distance cache is only safe to use from
+        one thread and a query only measures the few sites around one location
+    """
+
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        snapshot = self.service.snapshot
+
+        routes = {
+            '/health': self.get_health,
+            '/companies': self.get_companies,
+            '/summary': self.get_summary,
+            '/units_wip': self.get_units_wip,
+            '/interferences': self.get_interferences
+        }
+        route = routes.get(url.path)
+        if route is None:
+            self.send_json(404, {'error': f"unknown path {url.path}"})
+            return
+
+        try:
+            self.send_json(200, route(snapshot, params))
+        except KeyError as e:
+            self.send_json(404, {'error': f"unknown {e.args[0]}"})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/reload':
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+            return
+
+        try:
+            snapshot = self.service.reload()
+        except Exception as e:
+            logger.exception("reload failed, still serving the previous inputs")
+            self.send_json(500, {'error': f"reload failed: {e}"})
+            return
+
+        self.send_json(200, self.get_health(snapshot, {}))
+
+    def send_json(self, status, obj):
+        body = dumps_json(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def get_health(self, snapshot, params):
+        return {
+            'loaded_at': snapshot.loaded_at,
+            'companies': len(snapshot.company_site_arrays),
+            'sources': snapshot.source_stats
+        }
+
+    def get_companies(self, snapshot, params):
+        return snapshot.get_companies()
+
+    def get_summary(self, snapshot, params):
+        companies = params.get('company', list(snapshot.company_summaries))
+        return {company: get_entry(snapshot.company_summaries, company, 'company') for company in companies}
+
+    def get_units_wip(self, snapshot, params):
+        companies = params.get('company', list(snapshot.company_summaries))
+
+        units_wip = {}
+        for company in companies:
+            units_wip_by_city = get_entry(snapshot.company_summaries, company, 'company')['units_wip_by_city']
+            cities = params.get('city', list(units_wip_by_city))
+            units_wip[company] = {city: get_entry(units_wip_by_city, city, 'city') for city in cities}
+
+        return units_wip
+
+    def get_interferences(self, snapshot, params):
+        companies = params.get('company', list(snapshot.company_site_arrays))
+        for company in companies:
+            get_entry(snapshot.company_site_arrays, company, 'company')
+
+        radius = get_float_param(params, 'radius', snapshot.build_threshold, low=0, high=MAX_QUERY_RADIUS_MI)
+        if radius <= 0:
+            raise ValueError("parameter 'radius' must be positive")
+
+        return snapshot.query_site(
+            get_float_param(params, 'lat', low=-90, high=90),
+            get_float_param(params, 'lon', low=-180, high=180),
+            radius,
+            companies,
+            distance_mode=self.service.distance_mode
+        )
+
+
+def get_entry(entries, key, kind):
+    # the KeyError names what was not found, the handler answers it with a 404
+    if key not in entries:
+        raise KeyError(f"{kind} {key}")
+
+    return entries[key]
+
+
+def serve(service, host="127.0.0.1", port=8000):
+    """
+        load the inputs, then answer requests until interrupted while a thread reloads the inputs
+        whenever the watched files change
+    """
+    service.reload()
+
+    handler = type('BoundAnalysisRequestHandler', (AnalysisRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=service.watch, args=(stop_event,), name="input-watcher", daemon=True)
+    watcher.start()
+
+    logger.info(f"serving the analysis on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("stopping")
+    finally:
+        stop_event.set()
+        server.server_close()
@@ -0,0 +1,346 @@
+"""
+    benchmark of the analysis pipeline on a synthetic portfolio
+
+    generates N companies with construction and existing sites clustered around the metros in
+    largest_metros.txt, then times every stage of the pipeline (imports, ingest, metro assignment, pair
+    search, summarize, json write, map render) and records its peak memory. The results are written to
+    a json file so runs of different versions can be compared with --compare. No network access is needed
+
+    example:
+        python benchmark.py --companies 4 --construction 2000 --existing 5000 --output bench.json
+        python benchmark.py --companies 4 --construction 2000 --existing 5000 --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import driver
+from profiling import get_max_rss_mb
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# column names of the generated workbook, the same as the bundled cities_locations.xlsx
+EXISTING_LAT_KEY = 'ELat'
+EXISTING_LON_KEY = 'ELon'
+CONSTRUCTION_LAT_KEY = 'CLat'
+CONSTRUCTION_LON_KEY = 'CLon'
+NUM_UNITS_KEY = 'num units'
+
+MILES_PER_DEGREE_LAT = 69.0
+
+
+def generate_synthetic_portfolio(metro_coords_dict,
+                                 num_companies=3,
+                                 num_construction=1000,
+                                 num_existing=1000,
+                                 spread_mi=5.0,
+                                 metros_per_company=5,
+                                 seed=0):
+    """
+        {company: {'construction': df, 'existing': df}} in the layout of read_excel_file_to_dataframe.
+        every company is active in a few random metros and its sites are normally distributed around
+        them with a standard deviation of 'spread_mi' miles, so there are realistic clusters of interferences
+    """
+    rng = np.random.default_rng(seed)
+
+    metro_lats = np.array([coords[0] for coords in metro_coords_dict.values()])
+    metro_lons = np.array([coords[1] for coords in metro_coords_dict.values()])
+
+    def sample_sites(company_metros, num_sites):
+        site_metros = rng.choice(company_metros, size=num_sites)
+        lats = metro_lats[site_metros] + rng.normal(0, spread_mi / MILES_PER_DEGREE_LAT, num_sites)
+        lons = metro_lons[site_metros] + rng.normal(0, spread_mi / MILES_PER_DEGREE_LAT, num_sites) / np.cos(np.radians(lats))
+        return lats, lons
+
+    company_df_dict = {}
+    for company_idx in range(num_companies):
+        company_metros = rng.choice(len(metro_lats), size=min(metros_per_company, len(metro_lats)), replace=False)
+
+        construction_lats, construction_lons = sample_sites(company_metros, num_construction)
+        existing_lats, existing_lons = sample_sites(company_metros, num_existing)
+
+        company_df_dict[f"Company {company_idx}"] = {
+            'construction': pd.DataFrame({
+                CONSTRUCTION_LAT_KEY: construction_lats,
+                CONSTRUCTION_LON_KEY: construction_lons,
+                NUM_UNITS_KEY: rng.integers(10, 300, num_construction)
+            }),
+            'existing': pd.DataFrame({
+                EXISTING_LAT_KEY: existing_lats,
+                EXISTING_LON_KEY: existing_lons
+            })
+        }
+
+    return company_df_dict
+
+
+def write_synthetic_workbook(company_df_dict, filepath):
+    """
+        write the portfolio as a workbook with one sheet per company. A row holds one construction and
+        one existing site, so the smaller of the two sets is repeated to fill the rows
+    """
+    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+        for company_name, frames in company_df_dict.items():
+            num_rows = max(len(frames['construction']), len(frames['existing']))
+            existing_df = frames['existing'].iloc[np.arange(num_rows) % len(frames['existing'])].reset_index(drop=True)
+            construction_df = frames['construction'].iloc[np.arange(num_rows) % len(frames['construction'])].reset_index(drop=True)
+            pd.concat([existing_df, construction_df], axis=1).to_excel(writer, sheet_name=company_name, index=False)
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous_dir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_dir)
+
+
+def measure_stage(stage_results, stage_name, stage_function, measure_memory=True):
+    """
+        time stage_function() and, if requested, run it a second time under tracemalloc for the peak
+        memory (tracemalloc slows python code down, so it is kept out of the timed run)
+    """
+    logging.info(f"benchmark stage: {stage_name}")
+
+    start = time.perf_counter()
+    result = stage_function()
+    seconds = time.perf_counter() - start
+
+    stage_results[stage_name] = {'seconds': seconds}
+
+    if measure_memory:
+        tracemalloc.start()
+        stage_function()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stage_results[stage_name]['peak_memory_mb'] = peak_bytes / 2 ** 20
+
+    logging.info(f"benchmark stage: {stage_name} took {seconds:.3f} s")
+
+    return result
+
+
+def measure_imports(stage_results, repeats=3):
+    """
+        time importing driver and then map_layers in fresh interpreters, the best of 'repeats' runs.
+        import_driver is the startup cost of every run, import_maps what rendering the maps adds to it
+    """
+    logging.info("benchmark stage: imports")
+
+    code = (
+        "import time; start = time.perf_counter(); import driver; middle = time.perf_counter(); "
+        "import map_layers; print(middle - start, time.perf_counter() - middle)"
+    )
+    timings = [
+        [float(seconds) for seconds in subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR, text=True).split()]
+        for _ in range(repeats)
+    ]
+
+    stage_results['import_driver'] = {'seconds': min(driver_seconds for driver_seconds, _ in timings)}
+    stage_results['import_maps'] = {'seconds': min(maps_seconds for _, maps_seconds in timings)}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    """
+        generate the portfolio, run every stage in a scratch directory and return the results dictionary
+    """
+    with working_directory(REPO_DIR):
+        metro_coords_dict = driver.get_metro_coords_dict()
+
+    company_df_dict = generate_synthetic_portfolio(
+        metro_coords_dict,
+        num_companies=args.companies,
+        num_construction=args.construction,
+        num_existing=args.existing,
+        spread_mi=args.spread,
+        seed=args.seed
+    )
+
+    stage_results = {}
+    if args.import_repeats > 0:
+        measure_imports(stage_results, repeats=args.import_repeats)
+
+    scratch_dir = tempfile.mkdtemp(prefix="real_estate_benchmark_")
+    try:
+        with working_directory(scratch_dir):
+            os.makedirs("companies", exist_ok=True)
+
+            if not args.skip_ingest:
+                workbook_path = os.path.join(scratch_dir, "synthetic_locations.xlsx")
+                write_synthetic_workbook(company_df_dict, workbook_path)
+
+                company_df_dict = measure_stage(stage_results, 'ingest', lambda: driver.read_excel_file_to_dataframe(
+                    workbook_path,
+                    EXISTING_LAT_KEY,
+                    EXISTING_LON_KEY,
+                    CONSTRUCTION_LAT_KEY,
+                    CONSTRUCTION_LON_KEY,
+                    NUM_UNITS_KEY
+                ), args.memory)
+
+            # nearest metro of every site, the building block of the city_threshold rule
+            all_lats = np.concatenate([
+                frames[frame_name][lat_key].to_numpy(dtype=np.float64)
+                for frames in company_df_dict.values()
+                for frame_name, lat_key in [('construction', CONSTRUCTION_LAT_KEY), ('existing', EXISTING_LAT_KEY)]
+            ])
+            all_lons = np.concatenate([
+                frames[frame_name][lon_key].to_numpy(dtype=np.float64)
+                for frames in company_df_dict.values()
+                for frame_name, lon_key in [('construction', CONSTRUCTION_LON_KEY), ('existing', EXISTING_LON_KEY)]
+            ])
+            measure_stage(stage_results, 'metro_assignment', lambda: driver.MetroLookup(metro_coords_dict).nearest_ids(
+                all_lats, all_lons, distance_mode=args.distance_mode
+            ), args.memory)
+
+            all_company_analysis_results = measure_stage(stage_results, 'pair_search', lambda: driver.run(
+                company_df_dict,
+                metro_coords_dict,
+                EXISTING_LAT_KEY,
+                EXISTING_LON_KEY,
+                CONSTRUCTION_LAT_KEY,
+                CONSTRUCTION_LON_KEY,
+                NUM_UNITS_KEY,
+                build_threshold=args.build_threshold,
+                city_threshold=args.city_threshold,
+                distance_mode=args.distance_mode,
+                workers=args.workers
+            ), args.memory)
+
+            measure_stage(stage_results, 'summarize', lambda: driver.summarize_analysis(all_company_analysis_results), args.memory)
+
+            measure_stage(stage_results, 'json_write', lambda: driver.write_results_to_json(
+                all_company_analysis_results, results_format=args.results_format), args.memory)
+
+            if not args.skip_map:
+                measure_stage(stage_results, 'map_render', lambda: driver.map_all_results(
+                    metro_coords_dict,
+                    company_df_dict,
+                    CONSTRUCTION_LAT_KEY,
+                    CONSTRUCTION_LON_KEY,
+                    EXISTING_LAT_KEY,
+                    EXISTING_LON_KEY,
+                    build_threshold=args.build_threshold,
+                    city_threshold=args.city_threshold,
+                    render_mode=args.map_render_mode
+                ), args.memory)
+                stage_results['map_render']['output_mb'] = os.path.getsize("all_analysis_map.html") / 2 ** 20
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return {
+        'benchmark': 'real-estate-jk analysis pipeline',
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'params': {
+            'companies': args.companies,
+            'construction': args.construction,
+            'existing': args.existing,
+            'spread_mi': args.spread,
+            'seed': args.seed,
+            'build_threshold': args.build_threshold,
+            'city_threshold': args.city_threshold,
+            'distance_mode': args.distance_mode,
+            'workers': args.workers,
+            'map_render_mode': args.map_render_mode,
+            'results_format': args.results_format
+        },
+        'counts': {
+            'construction_sites': int(sum(len(frames['construction']) for frames in company_df_dict.values())),
+            'existing_sites': int(sum(len(frames['existing']) for frames in company_df_dict.values())),
+            'interferences': int(sum(len(results) for results in all_company_analysis_results.values()))
+        },
+        'stages': stage_results,
+        # None where the platform cannot measure it (see profiling.get_max_rss_mb)
+        'max_rss_mb': get_max_rss_mb()
+    }
+
+
+def compare_results(previous_results, results):
+    """
+        lines comparing the stage timings of a previous benchmark file with the current run
+    """
+    lines = [f"{'stage':<20}{'previous s':>12}{'current s':>12}{'ratio':>8}"]
+    for stage_name, stage in results['stages'].items():
+        previous_stage = previous_results.get('stages', {}).get(stage_name)
+        if previous_stage is None:
+            lines.append(f"{stage_name:<20}{'-':>12}{stage['seconds']:>12.3f}{'-':>8}")
+            continue
+        ratio = stage['seconds'] / previous_stage['seconds'] if previous_stage['seconds'] else float('inf')
+        lines.append(f"{stage_name:<20}{previous_stage['seconds']:>12.3f}{stage['seconds']:>12.3f}{ratio:>8.2f}")
+
+    if previous_results.get('params') != results['params']:
+        lines.append("warning: the benchmark parameters differ from the previous file")
+
+    return lines
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark the analysis pipeline on a synthetic portfolio")
+    parser.add_argument("--companies", type=int, default=3, help="number of companies (sheets)")
+    parser.add_argument("--construction", type=int, default=1000, help="construction sites per company")
+    parser.add_argument("--existing", type=int, default=1000, help="existing sites per company")
+    parser.add_argument("--spread", type=float, default=5.0, help="standard deviation in miles of the sites around a metro")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic portfolio")
+    parser.add_argument("--build-threshold", type=float, default=3, help="build_threshold of the analysis in miles")
+    parser.add_argument("--city-threshold", type=float, default=50, help="city_threshold of the analysis in miles")
+    parser.add_argument("--distance-mode", default='geodesic', choices=['haversine', 'vincenty', 'geodesic'])
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the pair search")
+    parser.add_argument("--skip-ingest", action="store_true", help="do not write and read back a workbook")
+    parser.add_argument("--skip-map", action="store_true", help="do not render the map")
+    parser.add_argument("--import-repeats", type=int, default=3,
+                        help="fresh interpreters the import times are measured in (0 skips them)")
+    parser.add_argument("--map-render-mode", default='clustered', choices=['markers', 'clustered'],
+                        help="render_mode of map_all_results")
+    parser.add_argument("--results-format", default='pretty', choices=['pretty', 'compact', 'ndjson'],
+                        help="results_format of write_results_to_json")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="do not measure peak memory per stage")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file the results are written to")
+    parser.add_argument("--compare", default=None, help="previous results file to compare the timings with")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    results = run_benchmark(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    for stage_name, stage in results['stages'].items():
+        memory = f", peak {stage['peak_memory_mb']:.1f} MB" if 'peak_memory_mb' in stage else ""
+        print(f"{stage_name:<20}{stage['seconds']:>10.3f} s{memory}")
+    print(f"wrote benchmark results to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            previous_results = json.load(f)
+        print("\n".join(compare_results(previous_results, results)))
@@ -0,0 +1,193 @@
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+from distance_engine import paired_distances
+
+# rows looked up in or written to the sqlite store per statement
+SQLITE_BATCH_SIZE = 10000
+
+# bump when the layout of the store or the distances of distance_engine change, so the distances
+# stored by older versions are dropped instead of being served
+CACHE_VERSION = 1
+
+
+class DistanceCache:
+    """
+        memoized distance_engine.paired_distances shared by the pair search and the metro lookup
+        (see SpatialGridIndex.query_radius and MetroLookup.nearest_ids)
+
+        distances are keyed by the distance mode and the four coordinates. Coordinates are used as
+        exact doubles, rounding them would change the distances and with them the results. The
+        most recently used 'max_entries' distances are kept in memory. With a 'path', distances are
+        also stored in a sqlite database shared by later runs, so repeating an analysis mostly reads
+        distances instead of computing them. New distances are written when flush() is called. The
+        store keeps at most 'max_stored' distances, the ones written first are removed on flush()
+
+        only the geodesic mode is worth caching, a haversine or vincenty distance (both vectorized)
+        costs less than a lookup
+    """
+
+    def __init__(self, path=None, max_entries=1000000, max_stored=20000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_stored = max_stored
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._connection = None
+
+    def __getstate__(self):
+        # worker processes get the configuration only, each opens its own connection to the store
+        return {'path': self.path, 'max_entries': self.max_entries, 'max_stored': self.max_stored}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # several worker processes may write at once, wait for their locks instead of failing
+            self._connection = sqlite3.connect(self.path, timeout=60)
+
+            # a store written by another version (or before the version was recorded) starts over,
+            # checked under the write lock so only one process drops it
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value INTEGER)")
+            version = self._connection.execute("SELECT value FROM metadata WHERE name = 'version'").fetchone()
+            if version is None or version[0] != CACHE_VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS distances")
+                self._connection.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (CACHE_VERSION,))
+
+            # rows keep their rowid in the order they were written, which is the order they are pruned in
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS distances ("
+                "mode TEXT, lat1 REAL, lon1 REAL, lat2 REAL, lon2 REAL, distance REAL, "
+                "UNIQUE (mode, lat1, lon1, lat2, lon2))"
+            )
+            self._connection.commit()
+
+        return self._connection
+
+    def _read_stored(self, keys):
+        """
+            {key: distance} for the keys found in the sqlite store
+        """
+        connection = self._connect()
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (mode TEXT, lat1 REAL, lon1 REAL, lat2 REAL, lon2 REAL)")
+
+        stored = {}
+        for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+            connection.execute("DELETE FROM lookup")
+            connection.executemany("INSERT INTO lookup VALUES (?, ?, ?, ?, ?)", keys[start:start + SQLITE_BATCH_SIZE])
+            rows = connection.execute(
+                "SELECT d.mode, d.lat1, d.lon1, d.lat2, d.lon2, d.distance FROM lookup l JOIN distances d "
+                "ON d.mode = l.mode AND d.lat1 = l.lat1 AND d.lon1 = l.lon1 AND d.lat2 = l.lat2 AND d.lon2 = l.lon2"
+            )
+            for mode, lat1, lon1, lat2, lon2, distance in rows:
+                stored[(mode, lat1, lon1, lat2, lon2)] = distance
+
+        # end the read transaction, an open one would block the other processes writing to the store
+        connection.commit()
+
+        return stored
+
+    def _remember(self, key, distance):
+        self.entries[key] = distance
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def paired_distances(self, lat1, lon1, lat2, lon2, mode='geodesic'):
+        """
+            the same miles as distance_engine.paired_distances(lat1, lon1, lat2, lon2, mode=mode),
+            only the pairs not seen before are computed
+        """
+        lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(coords, dtype=np.float64) for coords in [lat1, lon1, lat2, lon2]])
+        shape = lat1.shape
+
+        keys = [
+            (mode, coords[0], coords[1], coords[2], coords[3])
+            for coords in zip(lat1.ravel().tolist(), lon1.ravel().tolist(), lat2.ravel().tolist(), lon2.ravel().tolist())
+        ]
+
+        distances = np.empty(len(keys), dtype=np.float64)
+        missing_positions = []
+        for position, key in enumerate(keys):
+            distance = self.entries.get(key)
+            if distance is None:
+                missing_positions.append(position)
+            else:
+                self.entries.move_to_end(key)
+                distances[position] = distance
+        self.stats['memory_hits'] += len(keys) - len(missing_positions)
+
+        if missing_positions and self.path is not None:
+            stored = self._read_stored(list(dict.fromkeys(keys[position] for position in missing_positions)))
+            still_missing = []
+            for position in missing_positions:
+                distance = stored.get(keys[position])
+                if distance is None:
+                    still_missing.append(position)
+                else:
+                    distances[position] = distance
+                    self._remember(keys[position], distance)
+            self.stats['disk_hits'] += len(missing_positions) - len(still_missing)
+            missing_positions = still_missing
+
+        if missing_positions:
+            missing_positions = np.array(missing_positions)
+            distances[missing_positions] = paired_distances(
+                lat1.ravel()[missing_positions],
+                lon1.ravel()[missing_positions],
+                lat2.ravel()[missing_positions],
+                lon2.ravel()[missing_positions],
+                mode=mode
+            )
+            for position, distance in zip(missing_positions.tolist(), distances[missing_positions].tolist()):
+                self._remember(keys[position], distance)
+                if self.path is not None:
+                    self.pending[keys[position]] = distance
+            self.stats['misses'] += len(missing_positions)
+
+        return distances.reshape(shape)
+
+    def flush(self):
+        """
+            write the distances computed since the last flush to the sqlite store
+        """
+        if self.path is None or not self.pending:
+            return
+
+        connection = self._connect()
+        pending = [key + (distance,) for key, distance in self.pending.items()]
+        for start in range(0, len(pending), SQLITE_BATCH_SIZE):
+            connection.executemany(
+                "INSERT OR IGNORE INTO distances (mode, lat1, lon1, lat2, lon2, distance) VALUES (?, ?, ?, ?, ?, ?)",
+                pending[start:start + SQLITE_BATCH_SIZE]
+            )
+
+        # keep the most recently written max_stored distances
+        connection.execute("DELETE FROM distances WHERE rowid <= (SELECT max(rowid) FROM distances) - ?", (self.max_stored,))
+        connection.commit()
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_stats(self):
+        """
+            hit and miss counters plus the hit rate over every distance requested
+        """
+        requested = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+        hit_rate = (self.stats['memory_hits'] + self.stats['disk_hits']) / requested if requested else 0.0
+
+        return dict(self.stats, entries=len(self.entries), hit_rate=round(hit_rate, 4))
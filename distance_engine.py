@@ -0,0 +1,203 @@
+import numpy as np
+
+from profiling import count_event
+
+# mean earth radius in km, the same value geopy uses for its great circle distance
+EARTH_RADIUS_KM = 6371.009
+
+# WGS-84 ellipsoid (semi-major axis in km and flattening), the default ellipsoid of geopy.distance.geodesic
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+
+# geopy converts kilometers to miles by dividing by this number
+KM_PER_MILE = 1.609344
+
+# haversine: spherical earth, fastest, error up to ~0.5% of the distance
+# vincenty: ellipsoidal earth solved with numpy, agrees with geopy to well under a millimeter
+# geodesic: the exact Karney solution geopy uses, one pair at a time (slowest but the reference)
+DISTANCE_MODES = ['haversine', 'vincenty', 'geodesic']
+
+
+def _km_to_unit(distance_km, unit):
+    assert unit in ['mi', 'km'], f"unit {unit} is not valid. Must be mi or km"
+
+    if unit == 'mi':
+        return distance_km / KM_PER_MILE
+
+    return distance_km
+
+
+def haversine_distances(lat1, lon1, lat2, lon2):
+    """
+        great circle distance in km between (lat1, lon1) and (lat2, lon2) on a spherical earth.
+        inputs are degrees and may be any numpy broadcastable shapes
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    h = sin_dlat ** 2 + np.cos(lat1) * np.cos(lat2) * sin_dlon ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def geodesic_distances(lat1, lon1, lat2, lon2):
+    """
+        ellipsoidal distance in km computed pair by pair with geographiclib, which is what
+        geopy.distance.geodesic wraps. This is the reference the other modes are measured against
+    """
+    from geographiclib.geodesic import Geodesic
+
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)))
+
+    # geopy builds its solver with the ellipsoid in km, so the distances come out in km directly
+    # (solving in meters and dividing by 1000 differs in the last bits)
+    geod = Geodesic(WGS84_A_KM, WGS84_F)
+    distances = np.empty(lat1.shape, dtype=np.float64)
+    for idx in np.ndindex(lat1.shape):
+        distances[idx] = geod.Inverse(
+            float(lat1[idx]), float(lon1[idx]), float(lat2[idx]), float(lon2[idx]), Geodesic.DISTANCE
+        )['s12']
+
+    return distances
+
+
+def vincenty_distances(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    """
+        ellipsoidal distance in km using the vectorized Vincenty inverse formula on WGS-84.
+        the few nearly antipodal pairs where the iteration does not converge fall back to geodesic
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)))
+
+    a = WGS84_A_KM
+    f = WGS84_F
+    b = (1 - f) * a
+
+    # reduced latitudes
+    u1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    big_l = np.radians(lon2 - lon1)
+    lam = big_l.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_u2 * sin_lam) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+
+            # coincident points have sin_sigma == 0
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+
+            # both points on the equator have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_next = big_l + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+            )
+
+            # a converged pair keeps the lambda it converged with, so its distance is the same
+            # whichever other pairs are in the batch (e.g. after a prefilter or from the distance cache)
+            converged |= np.abs(lam_next - lam) < tol
+            lam = np.where(converged, lam, lam_next)
+            if converged.all():
+                break
+
+    u_sq = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (
+        cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    distances = b * big_a * (sigma - delta_sigma)
+
+    # vincenty does not converge for nearly antipodal points, solve those exactly
+    failed = ~converged | ~np.isfinite(distances)
+    if failed.any():
+        distances = np.array(distances, dtype=np.float64)
+        distances[failed] = geodesic_distances(lat1[failed], lon1[failed], lat2[failed], lon2[failed])
+
+    return distances
+
+
+def paired_distances(lat1, lon1, lat2, lon2, unit='mi', mode='geodesic'):
+    """
+        distance between each (lat1, lon1) and the matching (lat2, lon2) in 'unit'. Inputs are
+        broadcast against each other, so a single point against an array of points works as well
+    """
+    assert mode in DISTANCE_MODES, f"distance mode {mode} is not valid. Must be one of {DISTANCE_MODES}"
+
+    count_event('distance_calls')
+
+    if mode == 'haversine':
+        distance_km = haversine_distances(lat1, lon1, lat2, lon2)
+    elif mode == 'vincenty':
+        distance_km = vincenty_distances(lat1, lon1, lat2, lon2)
+    else:
+        distance_km = geodesic_distances(lat1, lon1, lat2, lon2)
+
+    count_event('distances_computed', np.size(distance_km))
+
+    return _km_to_unit(distance_km, unit)
+
+
+def pairwise_distances(lats1, lons1, lats2, lons2, unit='mi', mode='geodesic', block_size=1024):
+    """
+        full distance matrix of shape (len(lats1), len(lats2)) in 'unit'. Rows are computed
+        'block_size' at a time so the intermediate arrays of the vectorized modes stay bounded
+    """
+    lats1 = np.asarray(lats1, dtype=np.float64).ravel()
+    lons1 = np.asarray(lons1, dtype=np.float64).ravel()
+    lats2 = np.asarray(lats2, dtype=np.float64).ravel()
+    lons2 = np.asarray(lons2, dtype=np.float64).ravel()
+
+    distances = np.empty((len(lats1), len(lats2)), dtype=np.float64)
+    for start in range(0, len(lats1), block_size):
+        stop = start + block_size
+        distances[start:stop] = paired_distances(
+            lats1[start:stop, None],
+            lons1[start:stop, None],
+            lats2[None, :],
+            lons2[None, :],
+            unit=unit,
+            mode=mode
+        )
+
+    return distances
+
+
+def distance_mode_errors(lat1, lon1, lat2, lon2, unit='mi', sample_size=2000, seed=0):
+    """
+        maximum absolute error of every distance mode against geopy on (a random sample of)
+        the given point pairs, e.g. {'haversine': 0.0041, 'vincenty': 2e-12, 'geodesic': 0.0}
+        use this to choose the mode for a run
+    """
+    import geopy.distance
+
+    lat1, lon1, lat2, lon2 = (np.ravel(x) for x in np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2))))
+
+    if len(lat1) > sample_size:
+        sample_idx = np.random.default_rng(seed).choice(len(lat1), size=sample_size, replace=False)
+        lat1, lon1, lat2, lon2 = lat1[sample_idx], lon1[sample_idx], lat2[sample_idx], lon2[sample_idx]
+
+    reference = np.array([
+        getattr(geopy.distance.geodesic([la1, lo1], [la2, lo2]), 'miles' if unit == 'mi' else 'km')
+        for la1, lo1, la2, lo2 in zip(lat1, lon1, lat2, lon2)
+    ])
+
+    mode_errors = {}
+    for mode in DISTANCE_MODES:
+        distances = paired_distances(lat1, lon1, lat2, lon2, unit=unit, mode=mode)
+        mode_errors[mode] = float(np.max(np.abs(distances - reference))) if len(reference) else 0.0
+
+    return mode_errors
@@ -1,37 +1,33 @@
+import logging
 import os # for operating system
-import subprocess
 import sys
 
-try:
-    import numpy as np
-except ImportError:
-    print("numpy is not installed, installing now")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
-    import numpy as np
-
-try:
-    import pandas as pd
-except ImportError:
-    print("pandas is not installed, installing now")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "pandas"])
-    import pandas as pd
-
-try:
-    import folium
-except ImportError:
-    print("folium is not installed, installing now")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "folium"])
-    import folium
+import numpy as np
+import pandas as pd
+
+from distance_cache import DistanceCache
+from distance_engine import paired_distances
+from incremental_state import PAIR_FIELDS, get_state_signature, load_incremental_state, save_incremental_state
+from ingest_cache import load_cached_frames, save_cached_frames
+from profiling import Profiler, count_event, profile_company, stage, timed
+from results_store import INTERFERENCE_DTYPE, CompanyInterferences, get_str_from_coord
+from results_writer import RESULTS_FORMATS, dumps_json, write_json_results, write_ndjson_results
+from spatial_index import MetroLookup, SpatialGridIndex
+
+# folium and map_layers (maps) and analysis_service (--serve) are imported by the functions that use
+# them, and pandas only loads openpyxl when a workbook is parsed, so an analysis that reads the ingest
+# cache and writes no maps never imports any of them
+
+logger = logging.getLogger(__name__)
 
 
 # get the coordinates of cities from the textfile
-def get_metro_coords_dict():
+def get_metro_coords_dict(metro_loc_file="largest_metros.txt"):
 
     # ADD MORE CITIES TO THIS FOLLOW IN THE FORMAT:
     # City:N. Lat,W. Long (see largest_metros.txt) 
-    metro_loc_file = "largest_metros.txt"
 
-    print(f"creating metro name to coordinate lookup table from file {metro_loc_file}...")
+    logger.info(f"creating metro name to coordinate lookup table from file {metro_loc_file}...")
     metro_coords_lines = open(metro_loc_file, 'r').readlines()
 
     metro_cities = [mcl.split(":")[0].strip() for mcl in metro_coords_lines]
@@ -53,8 +49,18 @@ def read_excel_file_to_dataframe(
     existing_lon_key,
     construction_lat_key,
     construction_lon_key,
-    num_units_key
+    num_units_key,
+    cache_dir=None,
+    rebuild_cache=False
 ):
+    """
+        read every sheet (company) of the workbook into cleaned construction and existing dataframes
+
+        with a cache_dir the cleaned frames are also stored there as memory mapped columns (see
+        ingest_cache.py) and later runs load them instead of parsing the workbook. The cache is
+        keyed by the workbook modification time and hash and is ignored when stale or when
+        rebuild_cache is set, in which case the workbook is parsed and the cache rewritten
+    """
     # change the filename here and make sure that it is in the same folder as this file "driver.py"
     # the parent folder here is "real-estate-jk" and the path to the file is: ./real-estate-jk/cities_locations.xlsx
     
@@ -62,13 +68,28 @@ def read_excel_file_to_dataframe(
     # most likely you want to right click on the file name in the left panel and then click "copy path" and paste it below
     #filename = "./cities_locations.xlsx"  # replace with your filename
     filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
-    print(f"reading excel file to form dataframe from file: {filename}")
+
+    column_keys = [existing_lat_key, existing_lon_key, construction_lat_key, construction_lon_key, num_units_key]
+
+    if cache_dir is not None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), cache_dir)
+
+        if rebuild_cache:
+            logger.info("rebuilding the ingest cache")
+        else:
+            company_df_clean_dict = load_cached_frames(filepath, cache_dir, column_keys)
+            if company_df_clean_dict is not None:
+                logger.info(f"loaded cleaned dataframes for {filename} from the ingest cache in {cache_dir}")
+                return company_df_clean_dict
+            logger.info(f"ingest cache for {filename} is missing or stale, reading the workbook")
+
+    logger.info(f"reading excel file to form dataframe from file: {filename}")
     company_name_df_dict = pd.read_excel(filepath, engine='openpyxl', sheet_name=None)  # sheet_name=None is to handle multiple sheets
 
     company_df_clean_dict = {}
 
     for company_name, property_df in company_name_df_dict.items():
-        print(f"current company: {company_name}")
+        logger.info(f"current company: {company_name}")
         #print(type(property_df))
 
         # set a lookup for the company data
@@ -86,6 +107,10 @@ def read_excel_file_to_dataframe(
         company_df_clean_dict[company_name]['construction'] = clean_construction_df
         company_df_clean_dict[company_name]['existing'] = clean_existing_df
 
+    if cache_dir is not None:
+        cache_folder = save_cached_frames(filepath, cache_dir, column_keys, company_df_clean_dict)
+        logger.info(f"wrote the ingest cache to {cache_folder}")
+
     return company_df_clean_dict
 
 
@@ -108,18 +133,9 @@ def get_distance_between_points(lat1, lon1, lat2, lon2, unit='mi'):
 
     #print("in get_distance_between points")
     # calculate the distance between 2 coordinate pairs (lat N, lon W) in specified units
-    import geopy.distance
-
-    coords1 = [lat1, lon1]  # type tuple
-    coords2 = [lat2, lon2]  # type tuple
-
-    #print(f"coords1 = {coords1}")
-    #print(f"coords2 = {coords2}")
-
-    if unit == 'mi':
-        distance = geopy.distance.geodesic(coords1, coords2).miles
-    elif unit == 'km':
-        distance = geopy.distance.geodesic(coords1, coords2).km
+    # the geodesic mode of the distance engine gives the same distance as geopy.distance.geodesic
+    # without importing geopy
+    distance = float(paired_distances(lat1, lon1, lat2, lon2, unit=unit, mode='geodesic'))
 
     #print(f"distance from {coords1} to {coords2} is {distance} {unit}")
 
@@ -165,12 +181,432 @@ def get_city_from_coords(metro_coords, test_lat, test_lon, threshold=50):
     min_dist = dists[min_idx]
     closest_city = list(metro_coords.keys())[min_idx]
 
-    print(f"closest metro to ({test_lat }, {test_lon}) is {closest_city} with distance {min_dist} mi")
+    logger.debug(f"closest metro to ({test_lat }, {test_lon}) is {closest_city} with distance {min_dist} mi")
 
     return min_dist, closest_city
 
-def get_str_from_coord(lat, lon):
-    return ",".join([str(lat), str(lon)])
+def get_cities_from_coords(metro_coords, test_lats, test_lons, distance_mode='geodesic'):
+    """
+        batched version of get_city_from_coords: the closest metro for every test location in one
+        vectorized call. build a MetroLookup once and call its nearest() directly when looking up
+        many batches against the same metros
+
+        returns an array of minimal distances and a list of closest city names
+    """
+    return MetroLookup(metro_coords).nearest(test_lats, test_lons, distance_mode=distance_mode)
+
+
+def get_coord_arrays(df, lat_key, lon_key):
+    """
+        the 'lat_key' and 'lon_key' columns of the dataframe as contiguous float64 arrays
+    """
+    return (
+        np.ascontiguousarray(df[lat_key].to_numpy(dtype=np.float64)),
+        np.ascontiguousarray(df[lon_key].to_numpy(dtype=np.float64))
+    )
+
+
+def get_company_site_arrays(company_property_dict,
+                            existing_lat_key,
+                            existing_lon_key,
+                            construction_lat_key,
+                            construction_lon_key,
+                            num_units_key):
+    """
+        the columns used by the analysis converted once per company into contiguous float64 arrays,
+        {company_name: {'construction_lats', 'construction_lons', 'construction_units', 'existing_lats', 'existing_lons'}}.
+        every stage works from these arrays, nothing touches the dataframes row by row
+    """
+    company_site_arrays = {}
+    for company_name, property_df_dict in company_property_dict.items():
+        construction_df = property_df_dict['construction']
+        construction_lats, construction_lons = get_coord_arrays(construction_df, construction_lat_key, construction_lon_key)
+        existing_lats, existing_lons = get_coord_arrays(property_df_dict['existing'], existing_lat_key, existing_lon_key)
+
+        company_site_arrays[company_name] = {
+            'construction_lats': construction_lats,
+            'construction_lons': construction_lons,
+            'construction_units': np.ascontiguousarray(construction_df[num_units_key].to_numpy(dtype=np.float64)),
+            'existing_lats': existing_lats,
+            'existing_lons': existing_lons
+        }
+
+    return company_site_arrays
+
+
+def get_total_site_arrays(company_site_arrays):
+    """
+        the sites of every company (see get_company_site_arrays) joined into one set of arrays, in
+        company order, plus the position of the company of every site ('construction_company_ids'
+        and 'existing_company_ids')
+    """
+    site_arrays = {
+        field: np.concatenate([company_arrays[field] for company_arrays in company_site_arrays.values()] + [np.empty(0)])
+        for field in ['construction_lats', 'construction_lons', 'construction_units', 'existing_lats', 'existing_lons']
+    }
+
+    for site_type in ['construction', 'existing']:
+        site_arrays[f"{site_type}_company_ids"] = np.repeat(
+            np.arange(len(company_site_arrays)),
+            [len(company_arrays[f"{site_type}_lats"]) for company_arrays in company_site_arrays.values()]
+        )
+
+    return site_arrays
+
+
+def index_existing_sites(existing_lats,
+                         existing_lons,
+                         metro_coords_dict,
+                         build_threshold=1,
+                         city_threshold=None):
+    """
+        the part of search_construction_sites shared by every chunk of construction sites of one
+        company: the metro lookup and a spatial index over the existing sites, built once per company
+        and passed to search_indexed_sites for each chunk
+
+        with a city_threshold, existing sites too far from every metro for any of their pairs to pass
+        the city_threshold rule are left out of the index (see MetroLookup.may_be_counted)
+    """
+    # nearest metro lookup shared by every construction site, built once
+    metro_lookup = MetroLookup(metro_coords_dict)
+
+    indexed_existing_idxs = np.arange(len(existing_lats))
+    if city_threshold is not None:
+        with timed('metro_prefilter'):
+            indexed_existing_idxs = np.flatnonzero(metro_lookup.may_be_counted(existing_lats, existing_lons, build_threshold, city_threshold))
+        count_event('existing_sites_removed_by_metro', len(existing_lats) - len(indexed_existing_idxs))
+
+    # index the existing sites so the search around each construction site only sees its neighbours
+    existing_index = SpatialGridIndex(existing_lats[indexed_existing_idxs], existing_lons[indexed_existing_idxs], cell_size_mi=build_threshold)
+
+    return {
+        'existing_lats': existing_lats,
+        'existing_lons': existing_lons,
+        'indexed_existing_idxs': indexed_existing_idxs,
+        'existing_index': existing_index,
+        'metro_lookup': metro_lookup,
+        'build_threshold': build_threshold,
+        'city_threshold': city_threshold
+    }
+
+
+def search_indexed_sites(construction_lats,
+                         construction_lons,
+                         existing_sites,
+                         distance_mode='geodesic',
+                         distance_cache=None):
+    """
+        search_construction_sites for a chunk of construction sites against existing sites indexed
+        by index_existing_sites
+    """
+    existing_lats = existing_sites['existing_lats']
+    existing_lons = existing_sites['existing_lons']
+    indexed_existing_idxs = existing_sites['indexed_existing_idxs']
+    existing_index = existing_sites['existing_index']
+    metro_lookup = existing_sites['metro_lookup']
+    build_threshold = existing_sites['build_threshold']
+    city_threshold = existing_sites['city_threshold']
+
+    searched_sites = np.ones(len(construction_lats), dtype=bool)
+    if city_threshold is not None:
+        with timed('metro_prefilter'):
+            searched_sites = metro_lookup.may_be_counted(construction_lats, construction_lons, build_threshold, city_threshold)
+        count_event('construction_sites_removed_by_metro', len(searched_sites) - int(np.count_nonzero(searched_sites)))
+
+    no_match = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0, dtype=np.int64))
+
+    site_matches = []
+    for construction_lat, construction_lon, searched_site in zip(construction_lats, construction_lons, searched_sites.tolist()):
+
+        if not searched_site:
+            site_matches.append(no_match)
+            continue
+
+        # existing sites within build_threshold of the construction site and their distances
+        with timed('query_radius'):
+            indexed_idxs, construction_distances = existing_index.query_radius(
+                construction_lat,
+                construction_lon,
+                build_threshold,
+                distance_mode=distance_mode,
+                distance_cache=distance_cache
+            )
+        neighbour_idxs = indexed_existing_idxs[indexed_idxs]
+
+        # get the location of the city closest to the average of the existing and construction locations
+        avg_lats = (construction_lat + existing_lats[neighbour_idxs]) / 2
+        avg_lons = (construction_lon + existing_lons[neighbour_idxs]) / 2
+
+        # closest city for every neighbouring existing site in one batch
+        with timed('metro_assignment'):
+            min_dists, closest_city_ids = metro_lookup.nearest_ids(avg_lats, avg_lons, distance_mode=distance_mode, distance_cache=distance_cache)
+
+        site_matches.append((neighbour_idxs, construction_distances, min_dists, closest_city_ids))
+
+    count_event('construction_sites_searched', len(site_matches))
+
+    if distance_cache is not None:
+        distance_cache.flush()
+
+    return site_matches
+
+
+def search_construction_sites(construction_lats,
+                              construction_lons,
+                              existing_lats,
+                              existing_lons,
+                              metro_coords_dict,
+                              build_threshold=1,
+                              distance_mode='geodesic',
+                              distance_cache=None,
+                              city_threshold=None):
+    """
+        the independent part of the analysis for a chunk of construction sites of one company:
+        find the existing sites within build_threshold of each construction site and the closest
+        metro to the midpoint of each of those pairs. Nothing is counted here, so chunks can be
+        searched in any order or in other processes and then accumulated in order by run()
+
+        with a distance_cache (see distance_cache.py) the distances of both steps are memoized and
+        the new ones are written to its store once the chunk is searched
+
+        with a city_threshold, sites too far from every metro for any of their pairs to pass the
+        city_threshold rule are left out before the search (see MetroLookup.may_be_counted). Those
+        construction sites get no pairs, the pairs that are counted are the same as without it
+
+        searching several chunks against the same existing sites, index them once with
+        index_existing_sites and call search_indexed_sites per chunk instead
+
+        returns a list with one (existing_idxs, distances, min_city_dists, closest_city_ids) tuple per construction site,
+        the city ids being positions in metro_coords_dict
+    """
+    existing_sites = index_existing_sites(existing_lats, existing_lons, metro_coords_dict, build_threshold, city_threshold)
+
+    return search_indexed_sites(construction_lats, construction_lons, existing_sites, distance_mode, distance_cache)
+
+
+def get_chunk_bounds(num_items, workers=1, chunk_size=None):
+    """
+        split range(num_items) into contiguous (start, stop) chunks. By default a single worker
+        gets one chunk and a pool gets about four chunks per worker so uneven chunks still keep
+        it busy
+    """
+    if chunk_size is None:
+        chunk_size = int(np.ceil(num_items / (4 * workers))) if workers > 1 else num_items
+
+    chunk_size = max(1, chunk_size)
+
+    return [(start, min(start + chunk_size, num_items)) for start in range(0, num_items, chunk_size)]
+
+
+def count_company_interferences(company_name,
+                                construction_lats,
+                                construction_lons,
+                                construction_units,
+                                existing_lats,
+                                existing_lons,
+                                site_matches,
+                                metro_coords_dict,
+                                build_threshold=1,
+                                city_threshold=30,
+                                trace_every=1,
+                                construction_company_ids=None):
+    """
+        the ordered part of the analysis for one company: walk the construction sites in order
+        and count the interferences found by search_construction_sites ('site_matches', one entry
+        per construction site with indices into existing_lats/existing_lons), skipping construction
+        sites whose coordinates were already counted
+
+        with construction_company_ids (the cross company sites of run(variant='total')) a coordinate
+        is only skipped when the same company already counted it, so competitors building at the
+        same coordinates are all counted
+
+        returns the CompanyInterferences table of the company (see results_store.py)
+    """
+    logger.info(f"analyzing {company_name}")
+
+    # diagnostics for the company, logged once the company is done
+    company_counters = {
+        'construction_sites_checked': 0,
+        'construction_sites_skipped': 0,
+        'pairs_evaluated': 0,
+        'pairs_outside_city_threshold': 0,
+        'interferences': 0
+    }
+
+    city_names = list(metro_coords_dict.keys())
+
+    # coordinates of construction sites that are already counted, prevents double counting properties
+    counted_coord_keys = set()
+    counted_sites = []
+
+    # interference rows of every counted construction site, joined into one table at the end
+    interference_blocks = []
+
+    # iterate over the construction sites and the existing sites found near each of them
+    for cxn_pos, (construction_lat, construction_lon) in enumerate(zip(construction_lats.tolist(), construction_lons.tolist())):
+
+        construction_coord_str = get_str_from_coord(construction_lat, construction_lon)
+        construction_coord_key = construction_coord_str
+        if construction_company_ids is not None:
+            construction_coord_key = (int(construction_company_ids[cxn_pos]), construction_coord_str)
+
+        # per pair diagnostics only for the sampled construction sites and only when DEBUG is on
+        trace_site = trace_every > 0 and cxn_pos % trace_every == 0 and logger.isEnabledFor(logging.DEBUG)
+
+        # only make the comparison if the construction site hasn't been counted
+        if construction_coord_key in counted_coord_keys:
+            company_counters['construction_sites_skipped'] += 1
+            if trace_site:
+                logger.debug(f"skipping construction site: ({construction_lat}, {construction_lon}) since it was already counted")
+            continue
+
+        company_counters['construction_sites_checked'] += 1
+
+        # existing sites within build_threshold of the construction site found by the search
+        neighbour_idxs, construction_distances, min_dists, closest_city_ids = site_matches[cxn_pos]
+
+        # an interference needs the midpoint within city_threshold of a metro and the sites within build_threshold
+        is_within_city = min_dists <= city_threshold
+        is_interference = is_within_city & (construction_distances <= build_threshold)
+
+        company_counters['pairs_evaluated'] += len(neighbour_idxs)
+        company_counters['pairs_outside_city_threshold'] += int(np.count_nonzero(~is_within_city))
+
+        if trace_site:
+            logger.debug(f"construction site {construction_coord_str} with {construction_units[cxn_pos]} units wip has not been counted yet, and will be checked now")
+            for neighbour_pos, exst_idx in enumerate(neighbour_idxs):
+                logger.debug(
+                    f"existing site ({existing_lats[exst_idx]}, {existing_lons[exst_idx]}): "
+                    f"closest metro {city_names[closest_city_ids[neighbour_pos]]} at {min_dists[neighbour_pos]} mi "
+                    f"(within city: {is_within_city[neighbour_pos]}), "
+                    f"distance {construction_distances[neighbour_pos]} mi (interference: {is_interference[neighbour_pos]})"
+                )
+
+        num_interferences = int(np.count_nonzero(is_interference))
+        if num_interferences == 0:
+            continue
+
+        # mark construction site as counted to prevent double counting of units in progress
+        counted_coord_keys.add(construction_coord_key)
+        counted_sites.append(cxn_pos)
+        company_counters['interferences'] += num_interferences
+
+        site_interferences = np.empty(num_interferences, dtype=INTERFERENCE_DTYPE)
+        site_interferences['construction_idx'] = cxn_pos
+        site_interferences['existing_idx'] = neighbour_idxs[is_interference]
+        site_interferences['city_id'] = closest_city_ids[is_interference]
+        site_interferences['distance'] = construction_distances[is_interference]
+        site_interferences['units'] = int(construction_units[cxn_pos])
+        interference_blocks.append(site_interferences)
+
+    logger.info(f"{company_name}: " + ", ".join(f"{name} {value}" for name, value in company_counters.items()))
+    for name, value in company_counters.items():
+        count_event(name, value)
+
+    return CompanyInterferences(
+        company_name,
+        city_names,
+        construction_lats,
+        construction_lons,
+        construction_units,
+        existing_lats,
+        existing_lons,
+        np.concatenate(interference_blocks) if interference_blocks else np.empty(0, dtype=INTERFERENCE_DTYPE),
+        counted_sites
+    )
+
+
+# existing sites of every company indexed by index_existing_sites, set once in each worker process
+_worker_existing_sites = None
+
+
+def _init_search_worker(company_existing_sites):
+    global _worker_existing_sites
+    _worker_existing_sites = company_existing_sites
+
+
+def _search_worker_chunk(company_name, construction_lats, construction_lons, distance_mode, distance_cache):
+    return search_indexed_sites(construction_lats, construction_lons, _worker_existing_sites[company_name], distance_mode, distance_cache)
+
+
+def search_company_sites(company_site_arrays,
+                         metro_coords_dict,
+                         build_threshold=1,
+                         distance_mode='geodesic',
+                         workers=1,
+                         chunk_size=None,
+                         distance_cache=None,
+                         city_threshold=None):
+    """
+        search_construction_sites for every company of company_site_arrays (see get_company_site_arrays).
+        The existing sites of each company are indexed once, then its construction sites are searched
+        in chunks of 'chunk_size' in a process pool when workers > 1. Every worker process receives the
+        indexed existing sites once when it starts and only construction sites per chunk. Worker
+        processes get their own copy of the distance_cache, sharing only its on disk store.
+        city_threshold turns on the metro prefilter of search_construction_sites
+
+        returns {company_name: site_matches} with one entry per construction site, in order
+    """
+    company_site_matches = {}
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        company_existing_sites = {
+            company_name: index_existing_sites(
+                site_arrays['existing_lats'],
+                site_arrays['existing_lons'],
+                metro_coords_dict,
+                build_threshold,
+                city_threshold
+            )
+            for company_name, site_arrays in company_site_arrays.items()
+        }
+
+        logger.info(f"searching construction sites with {workers} worker processes")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_search_worker, initargs=(company_existing_sites,)) as pool:
+            company_futures = {
+                company_name: [
+                    pool.submit(
+                        _search_worker_chunk,
+                        company_name,
+                        site_arrays['construction_lats'][start:stop],
+                        site_arrays['construction_lons'][start:stop],
+                        distance_mode,
+                        distance_cache
+                    )
+                    for start, stop in get_chunk_bounds(len(site_arrays['construction_lats']), workers, chunk_size)
+                ]
+                for company_name, site_arrays in company_site_arrays.items()
+            }
+            # collect in submission order so the merge is deterministic
+            for company_name, futures in company_futures.items():
+                company_site_matches[company_name] = [match for future in futures for match in future.result()]
+    else:
+        for company_name, site_arrays in company_site_arrays.items():
+            with profile_company(company_name):
+                existing_sites = index_existing_sites(
+                    site_arrays['existing_lats'],
+                    site_arrays['existing_lons'],
+                    metro_coords_dict,
+                    build_threshold,
+                    city_threshold
+                )
+                company_site_matches[company_name] = [
+                    match
+                    for start, stop in get_chunk_bounds(len(site_arrays['construction_lats']), workers, chunk_size)
+                    for match in search_indexed_sites(
+                        site_arrays['construction_lats'][start:stop],
+                        site_arrays['construction_lons'][start:stop],
+                        existing_sites,
+                        distance_mode,
+                        distance_cache
+                    )
+                ]
+
+        if distance_cache is not None:
+            logger.info("distance cache: " + ", ".join(f"{name} {value}" for name, value in distance_cache.get_stats().items()))
+
+    return company_site_matches
 
 
 def run(company_property_dict,
@@ -182,212 +618,837 @@ def run(company_property_dict,
         num_units_key,
         build_threshold=1,
         city_threshold=30,
-        variant='company'):
+        variant='company',
+        distance_mode='geodesic',
+        workers=1,
+        chunk_size=None,
+        trace_every=1,
+        distance_cache=None):
     
     """
         the main entrypoint for the analysis. Reads over the existing and construction
         dataframes and tracks which cities have interferences based on preset thresholds
         this function populates multiple dictionaries of interest, outlined below
+
+        distance_mode selects how the distance engine measures distances (see distance_engine.py):
+        'geodesic' reproduces geopy exactly, 'vincenty' and 'haversine' are vectorized and faster.
+        existing sites are put in a spatial grid index, so each construction site is only compared
+        with the existing sites within build_threshold instead of with every existing site. Before
+        any distance is measured, sites too far from every metro to pass city_threshold are left
+        out and the candidates of the grid are narrowed to the bounding box of build_threshold
+
+        the search for each construction site is independent, so with workers > 1 the companies and
+        chunks of 'chunk_size' construction sites are searched in a process pool. The results are
+        then counted serially in the original order, so the output is identical to workers=1
+
+        progress and a summary of counters per company are logged at INFO level. The per pair
+        diagnostics are only logged at DEBUG level and only for every 'trace_every'-th construction
+        site, so a sampled trace of large runs stays readable
+
+        a distance_cache (see distance_cache.py) memoizes the distances of the search across runs
+
+        variant 'total' checks the construction sites of every company against the existing sites of
+        every company. All sites go into one spatial index instead of comparing company by company,
+        and the results are a single 'total' entry organized by city, which also knows the company of
+        every site (CompanyInterferences.get_interference_counts_by_company). Construction sites at
+        the same coordinates are counted once per company, a competitor building at the same
+        coordinates is counted as well
     """
 
     # describes the analysis of interest. Company keeps interferences organized by company
     # total combines all interferences and organizes by city irrespective of company
     assert variant in ['company', 'total']
 
-    print(f"now running property distance analysis variant: {variant}")
+    logger.info(f"now running property distance analysis variant: {variant}")
+
+    # the columns of every company as arrays, converted once for all stages
+    company_site_arrays = get_company_site_arrays(
+        company_property_dict,
+        existing_lat_key,
+        existing_lon_key,
+        construction_lat_key,
+        construction_lon_key,
+        num_units_key
+    )
 
-    total_overall_interferences = 0
+    if variant == 'total':
+        company_names = list(company_site_arrays.keys())
+        company_site_arrays = {'total': get_total_site_arrays(company_site_arrays)}
+
+    with stage('search'):
+        company_site_matches = search_company_sites(
+            company_site_arrays,
+            metro_coords_dict,
+            build_threshold=build_threshold,
+            distance_mode=distance_mode,
+            workers=workers,
+            chunk_size=chunk_size,
+            distance_cache=distance_cache,
+            city_threshold=city_threshold
+        )
 
     all_company_analysis_results = {}
 
-    for company_name, property_df_dict in company_property_dict.items():
+    for company_name, site_arrays in company_site_arrays.items():
+
+        with stage('count'), profile_company(company_name):
+            all_company_analysis_results[company_name] = count_company_interferences(
+                company_name,
+                site_arrays['construction_lats'],
+                site_arrays['construction_lons'],
+                site_arrays['construction_units'],
+                site_arrays['existing_lats'],
+                site_arrays['existing_lons'],
+                company_site_matches[company_name],
+                metro_coords_dict,
+                build_threshold=build_threshold,
+                city_threshold=city_threshold,
+                trace_every=trace_every,
+                construction_company_ids=site_arrays.get('construction_company_ids')
+            )
+
+    if variant == 'total':
+        all_company_analysis_results['total'].set_site_companies(
+            company_names,
+            company_site_arrays['total']['construction_company_ids'],
+            company_site_arrays['total']['existing_company_ids']
+        )
+
+    logger.info("analysis complete")
+
+    return all_company_analysis_results
 
-        # company name string
-        # property_df_dict = { 'construction': df, 'existing': df }
 
-        print(f"analyzing {company_name}")
+def get_company_pair_table(construction_lats, construction_lons, site_matches):
+    """
+        the pairs found by search_construction_sites as flat arrays, keeping only the first
+        construction site at every coordinate. Later sites at the same coordinate have the same
+        pairs, so count_company_interferences only ever counts the first one for any threshold
 
-        # top level data entry for each company
-        all_company_analysis_results[company_name] = {
-            'total_company_interferences': 0,  # rolling sum across all property owned by company
-            'construction_sites_counted': {},  # {(lat, lon) : bool is_counted } prevent double counting properties
-            'units_wip_by_city': {},  # {city: int}
-            'interferences_by_city': {},  # track interferences by city { city: { lat_lon (of construction site): [((elat, elon), dist, num_units)]}}
-            'all_distances': [],  # list of all distances between construction and existing sites
-            'interference_count_by_city': {}, # track the number of interferences by city { city: int }
-            'total_units_wip': 0 # total units under construction for company
+        rows are ordered by construction site and then existing site, the order they are counted in
+    """
+    seen_coord_strs = set()
+    construction_idxs = []
+    kept_matches = []
+    for cxn_pos, (construction_lat, construction_lon) in enumerate(zip(construction_lats.tolist(), construction_lons.tolist())):
+        construction_coord_str = get_str_from_coord(construction_lat, construction_lon)
+        if construction_coord_str in seen_coord_strs:
+            continue
+        seen_coord_strs.add(construction_coord_str)
+
+        construction_idxs.append(np.full(len(site_matches[cxn_pos][0]), cxn_pos, dtype=np.int64))
+        kept_matches.append(site_matches[cxn_pos])
+
+    if not kept_matches:
+        return {
+            'construction_idx': np.empty(0, dtype=np.int64),
+            'existing_idx': np.empty(0, dtype=np.int64),
+            'distance': np.empty(0, dtype=np.float64),
+            'min_city_dist': np.empty(0, dtype=np.float64),
+            'city_id': np.empty(0, dtype=np.int64)
         }
 
+    neighbour_idxs, distances, min_dists, closest_city_ids = zip(*kept_matches)
+
+    return {
+        'construction_idx': np.concatenate(construction_idxs),
+        'existing_idx': np.concatenate(neighbour_idxs),
+        'distance': np.concatenate(distances),
+        'min_city_dist': np.concatenate(min_dists),
+        'city_id': np.concatenate(closest_city_ids)
+    }
+
+
+def count_threshold_interferences(company_name,
+                                  construction_lats,
+                                  construction_lons,
+                                  construction_units,
+                                  existing_lats,
+                                  existing_lons,
+                                  pair_table,
+                                  metro_coords_dict,
+                                  build_threshold=1,
+                                  city_threshold=30):
+    """
+        the CompanyInterferences table for one pair of thresholds, selected with a mask over the
+        pair table (see get_company_pair_table) of a search at a build_threshold at least as large.
+        The result is the same as count_company_interferences gives for a search at these thresholds
+    """
+    is_interference = (pair_table['distance'] <= build_threshold) & (pair_table['min_city_dist'] <= city_threshold)
+    construction_idxs = pair_table['construction_idx'][is_interference]
+
+    interferences = np.empty(len(construction_idxs), dtype=INTERFERENCE_DTYPE)
+    interferences['construction_idx'] = construction_idxs
+    interferences['existing_idx'] = pair_table['existing_idx'][is_interference]
+    interferences['city_id'] = pair_table['city_id'][is_interference]
+    interferences['distance'] = pair_table['distance'][is_interference]
+    interferences['units'] = construction_units[construction_idxs].astype(np.int64)
+
+    return CompanyInterferences(
+        company_name,
+        list(metro_coords_dict.keys()),
+        construction_lats,
+        construction_lons,
+        construction_units,
+        existing_lats,
+        existing_lons,
+        interferences,
+        # rows are grouped by construction site in counting order, so the sorted unique sites are the counted ones in order
+        np.unique(construction_idxs)
+    )
+
 
-        # init interferences by city and total wip units by city
-        for city_name, coords in metro_coords_dict.items():
+def run_threshold_sweep(company_property_dict,
+                        metro_coords_dict,
+                        existing_lat_key,
+                        existing_lon_key,
+                        construction_lat_key,
+                        construction_lon_key,
+                        num_units_key,
+                        build_thresholds,
+                        city_thresholds,
+                        distance_mode='geodesic',
+                        workers=1,
+                        chunk_size=None,
+                        distance_cache=None):
+    """
+        the analysis for every combination of build_thresholds and city_thresholds in one pass.
+        The sites are searched once at the largest build threshold, every combination is then a
+        mask over the pairs found, so a sweep costs about as much as a single run
 
-            all_company_analysis_results[company_name]['units_wip_by_city'][city_name] = 0
-            all_company_analysis_results[company_name]['interferences_by_city'][city_name] = {}
-            all_company_analysis_results[company_name]['interference_count_by_city'][city_name] = 0
+        returns {(build_threshold, city_threshold): {company_name: CompanyInterferences}}, each the
+        same as run() gives for those thresholds
+    """
+    build_thresholds = sorted(set(build_thresholds))
+    city_thresholds = sorted(set(city_thresholds))
 
-        construction_df = property_df_dict['construction']
-        existing_df = property_df_dict['existing']
+    logger.info(f"sweeping build thresholds {build_thresholds} and city thresholds {city_thresholds}")
+
+    company_site_arrays = get_company_site_arrays(
+        company_property_dict,
+        existing_lat_key,
+        existing_lon_key,
+        construction_lat_key,
+        construction_lon_key,
+        num_units_key
+    )
 
-        # initialize the construction sites counted dictionary
-        for ctup in construction_df.itertuples():
-            #print(f"row tuple: {ctup} type row: {ctup.CLat}")
-            construction_lat = ctup.CLat
-            construction_lon = ctup.CLon
+    company_site_matches = search_company_sites(
+        company_site_arrays,
+        metro_coords_dict,
+        build_threshold=build_thresholds[-1],
+        distance_mode=distance_mode,
+        workers=workers,
+        chunk_size=chunk_size,
+        distance_cache=distance_cache,
+        city_threshold=city_thresholds[-1]
+    )
 
-            construction_coord_str = ",".join([str(construction_lat), str(construction_lon)])
+    company_pair_tables = {
+        company_name: get_company_pair_table(
+            site_arrays['construction_lats'],
+            site_arrays['construction_lons'],
+            company_site_matches[company_name]
+        )
+        for company_name, site_arrays in company_site_arrays.items()
+    }
+
+    sweep_results = {}
+    for build_threshold in build_thresholds:
+        for city_threshold in city_thresholds:
+            sweep_results[(build_threshold, city_threshold)] = {
+                company_name: count_threshold_interferences(
+                    company_name,
+                    site_arrays['construction_lats'],
+                    site_arrays['construction_lons'],
+                    site_arrays['construction_units'],
+                    site_arrays['existing_lats'],
+                    site_arrays['existing_lons'],
+                    company_pair_tables[company_name],
+                    metro_coords_dict,
+                    build_threshold=build_threshold,
+                    city_threshold=city_threshold
+                )
+                for company_name, site_arrays in company_site_arrays.items()
+            }
+
+    logger.info(f"threshold sweep complete, {len(sweep_results)} combinations")
+
+    return sweep_results
+
+
+def get_coord_keys(lats, lons):
+    """
+        one comparable and sortable number per coordinate (the latitude as real and the longitude as
+        imaginary part), so sets of sites can be diffed with numpy set operations
+    """
+    return np.asarray(lats, dtype=np.float64) + 1j * np.asarray(lons, dtype=np.float64)
 
-            all_company_analysis_results[company_name]['construction_sites_counted'][construction_coord_str] = False
-    
-        # iterate over the actual construction and existing building data pairwise to get distances
-        for cxn_index, cxn_row in construction_df.iterrows():
-
-            construction_lat = cxn_row[construction_lat_key]
-            construction_lon = cxn_row[construction_lon_key]
-            
-            construction_coord_str = get_str_from_coord(construction_lat, construction_lon)
-
-            construction_site_was_counted = all_company_analysis_results[company_name]['construction_sites_counted'][construction_coord_str]
-        
-            # only make the comparison if the construction site hasn't been counted
-            if construction_site_was_counted is False:
-
-                # get the # construction units wip
-                num_units_wip = cxn_row[num_units_key]
-                print(f"num units wip: {num_units_wip}")
-
-                # the construction has not been counted, so look at the existing units nearby
-                print(f"construction site {construction_coord_str} has not been counted yet, and will be checked now")
-                units_counted = False
-                for exst_index, exst_row in existing_df.iterrows():
-                    
-                    #print(f"existing {exst_row}")
-                    # obtain the coordinates from current df location
-                    existing_lat = exst_row[existing_lat_key]
-                    existing_lon = exst_row[existing_lon_key]
-
-                    #existing_coord = (existing_lat, existing_lon)
-
-                    # get the location of the city closest to the average of the existing and construction locations
-                    avg_lat = (construction_lat + existing_lat) / 2
-                    avg_lon = (construction_lon + existing_lon) / 2
-
-                    # get the closest city based on the average of the existing and construction locations
-                    min_dist, closest_city = get_city_from_coords(metro_coords_dict, avg_lat, avg_lon)
-                    is_within_city = is_within_threshold(min_dist, city_threshold)
-                    print(f"is within city: {is_within_city} with distance {min_dist} and threshold {city_threshold}")
-                    if is_within_city:  # we are in a city of interest
-                    
-                        print(f"existing lat {existing_lat} lon {existing_lon} is closest to {closest_city}")
-                        print(f"construction lat {construction_lat} lon {construction_lon} is closest to {closest_city} with threshold {city_threshold}")
-                        distance_btwn_construction_and_existing = get_distance_between_points(
-                            existing_lat,
-                            existing_lon,
-                            construction_lat,
-                            construction_lon
-                        )
-
-                        is_within_construction = is_within_threshold(distance_btwn_construction_and_existing, build_threshold)
-                        print(f"is_within_construction: {is_within_construction} with distance {distance_btwn_construction_and_existing} and threshold {build_threshold}")
-
-                        if is_within_construction:  #and all_company_analysis_results[company_name]['construction_sites_counted'][construction_coord_str] is False:  # we have a construction interference with an existing building
-
-                            print(f"interference in city: {closest_city}")
-
-                            # mark construction site as visited to prevent double counting of units in progress
-                            all_company_analysis_results[company_name]['construction_sites_counted'][construction_coord_str] = True
-
-                            # all construction coords that are already counted
-                            interf_by_coord_keys = all_company_analysis_results[company_name]['interferences_by_city'][closest_city].keys()
-                            
-                            existing_coord_str = get_str_from_coord(existing_lat, existing_lon)
-
-                            coord_units_dist_entry_str = ":".join([existing_coord_str, str(int(num_units_wip)), str(distance_btwn_construction_and_existing)])
-
-                            if construction_coord_str not in interf_by_coord_keys:  # check if intereference list exists
-                                all_company_analysis_results[company_name]['interferences_by_city'][closest_city][construction_coord_str] = [coord_units_dist_entry_str]
-                            else:  # the list of interferences already exists, add to it
-                                all_company_analysis_results[company_name]['interferences_by_city'][closest_city][construction_coord_str].append(coord_units_dist_entry_str)
-
-                            # update the overall and citywise units interfering count
-                            total_overall_interferences += 1
-                            all_company_analysis_results[company_name]['total_company_interferences'] += 1
-
-                            # add the distance to the list of all distances
-                            all_company_analysis_results[company_name]['all_distances'].append(distance_btwn_construction_and_existing)
-
-                            # update the number of interferences and units wip by city 
-                            all_company_analysis_results[company_name]['interference_count_by_city'][closest_city] += 1
-                            #if construction_coord_str in units_wip_by_city_keys:
-                            
-                            # update the interfering units for the city
-                            if not units_counted:
-                                all_company_analysis_results[company_name]['total_units_wip'] += num_units_wip
-                                all_company_analysis_results[company_name]['units_wip_by_city'][closest_city] += int(num_units_wip)
-                                units_counted = True
-                            else:
-                                print("units already counted, skipping")
-                        else:
-                            print("in city but not a construction interference")
-                    else:
-                        print(f"skipping existing unit: ({existing_lat}, {existing_lon}) since it is not in the city threshold")
 
-            else:
-                print(f"skipping construction site: ({construction_lat}, {construction_lon}) since it was already counted")
+def search_site_pairs(construction_lats,
+                      construction_lons,
+                      existing_lats,
+                      existing_lons,
+                      metro_coords_dict,
+                      build_threshold=1,
+                      distance_mode='geodesic',
+                      distance_cache=None):
+    """
+        search_construction_sites flattened into one row per (construction, existing) pair within
+        build_threshold, keyed by the coordinates of both sites (see incremental_state.PAIR_FIELDS)
+    """
+    site_matches = search_construction_sites(
+        construction_lats,
+        construction_lons,
+        existing_lats,
+        existing_lons,
+        metro_coords_dict,
+        build_threshold,
+        distance_mode,
+        distance_cache
+    )
+
+    num_pairs = [len(site_match[0]) for site_match in site_matches]
+    existing_idxs = np.concatenate([site_match[0] for site_match in site_matches] + [np.empty(0, dtype=np.int64)])
+
+    return {
+        'construction_lats': np.repeat(construction_lats, num_pairs),
+        'construction_lons': np.repeat(construction_lons, num_pairs),
+        'existing_lats': existing_lats[existing_idxs],
+        'existing_lons': existing_lons[existing_idxs],
+        'distances': np.concatenate([site_match[1] for site_match in site_matches] + [np.empty(0)]),
+        'min_city_dists': np.concatenate([site_match[2] for site_match in site_matches] + [np.empty(0)]),
+        'city_ids': np.concatenate([site_match[3] for site_match in site_matches] + [np.empty(0, dtype=np.int64)])
+    }
+
+
+def get_site_matches_from_pairs(pairs, construction_lats, construction_lons, existing_lats, existing_lons):
+    """
+        turn coordinate keyed pairs back into the per construction site matches of
+        search_construction_sites for the given construction and existing rows. Every row with
+        the coordinates of a pair gets the pair, and the existing sites stay in row order
+    """
+    pair_construction_keys = get_coord_keys(pairs['construction_lats'], pairs['construction_lons'])
+    pair_existing_keys = get_coord_keys(pairs['existing_lats'], pairs['existing_lons'])
+
+    # the rows of every existing coordinate
+    existing_keys, existing_inverse = np.unique(get_coord_keys(existing_lats, existing_lons), return_inverse=True)
+    existing_rows = np.argsort(existing_inverse, kind='stable')
+    existing_counts = np.bincount(existing_inverse, minlength=len(existing_keys))
+    existing_starts = np.concatenate([[0], np.cumsum(existing_counts)[:-1]]).astype(np.int64)
+
+    # the pairs of every construction coordinate
+    pair_order = np.argsort(pair_construction_keys, kind='stable')
+    sorted_construction_keys = pair_construction_keys[pair_order]
+
+    site_matches = []
+    for construction_key in get_coord_keys(construction_lats, construction_lons):
+        lo = np.searchsorted(sorted_construction_keys, construction_key, side='left')
+        hi = np.searchsorted(sorted_construction_keys, construction_key, side='right')
+        pair_idxs = pair_order[lo:hi]
+
+        # every existing row at the coordinates of each pair
+        existing_key_idxs = np.searchsorted(existing_keys, pair_existing_keys[pair_idxs])
+        reps = existing_counts[existing_key_idxs]
+        neighbour_idxs = np.concatenate(
+            [existing_rows[existing_starts[k]:existing_starts[k] + existing_counts[k]] for k in existing_key_idxs]
+            + [np.empty(0, dtype=np.int64)]
+        )
+
+        row_order = np.argsort(neighbour_idxs, kind='stable')
+        site_matches.append((
+            neighbour_idxs[row_order],
+            np.repeat(pairs['distances'][pair_idxs], reps)[row_order],
+            np.repeat(pairs['min_city_dists'][pair_idxs], reps)[row_order],
+            np.repeat(pairs['city_ids'][pair_idxs], reps)[row_order]
+        ))
+
+    return site_matches
+
+
+def run_incremental(company_property_dict,
+                    metro_coords_dict,
+                    existing_lat_key,
+                    existing_lon_key,
+                    construction_lat_key,
+                    construction_lon_key,
+                    num_units_key,
+                    state_path,
+                    build_threshold=1,
+                    city_threshold=30,
+                    distance_mode='geodesic',
+                    trace_every=1,
+                    distance_cache=None):
+    """
+        the same analysis as run(), reusing the pairs found by the previous run stored in 'state_path'.
+        sites are fingerprinted by their coordinates: only new construction sites (against all existing
+        sites) and new existing sites (against the unchanged construction sites) are searched, pairs of
+        removed or moved sites are dropped. The counting step then runs on all pairs as usual, which is
+        linear in the number of pairs, so the results always equal a full run
+
+        the state is only reused when build_threshold, distance_mode and the metros are unchanged
+    """
+    logger.info(f"now running incremental property distance analysis with state {state_path}")
+
+    signature = get_state_signature(metro_coords_dict, build_threshold, distance_mode)
+    previous_states = load_incremental_state(state_path, signature)
+
+    company_states = {}
+    all_company_analysis_results = {}
+
+    company_site_arrays = get_company_site_arrays(
+        company_property_dict,
+        existing_lat_key,
+        existing_lon_key,
+        construction_lat_key,
+        construction_lon_key,
+        num_units_key
+    )
+
+    for company_name, site_arrays in company_site_arrays.items():
+
+        construction_lats = site_arrays['construction_lats']
+        construction_lons = site_arrays['construction_lons']
+        existing_lats = site_arrays['existing_lats']
+        existing_lons = site_arrays['existing_lons']
+
+        # the distinct sites, a pair only depends on the coordinates of its two sites
+        construction_keys = np.unique(get_coord_keys(construction_lats, construction_lons))
+        existing_keys = np.unique(get_coord_keys(existing_lats, existing_lons))
+
+        previous_state = previous_states.get(company_name)
+        if previous_state is None:
+            logger.info(f"{company_name}: no previous state, searching all sites")
+            searched_construction_keys = np.empty(0, dtype=np.complex128)
+            searched_existing_keys = np.empty(0, dtype=np.complex128)
+            kept_pairs = None
+        else:
+            searched_construction_keys = get_coord_keys(
+                previous_state['searched_construction_lats'], previous_state['searched_construction_lons'])
+            searched_existing_keys = get_coord_keys(
+                previous_state['searched_existing_lats'], previous_state['searched_existing_lons'])
+
+            # pairs whose sites are both still there
+            is_kept = np.isin(
+                get_coord_keys(previous_state['construction_lats'], previous_state['construction_lons']), construction_keys
+            ) & np.isin(
+                get_coord_keys(previous_state['existing_lats'], previous_state['existing_lons']), existing_keys
+            )
+            kept_pairs = {field: previous_state[field][is_kept] for field in PAIR_FIELDS}
+
+        added_construction_keys = np.setdiff1d(construction_keys, searched_construction_keys)
+        unchanged_construction_keys = np.intersect1d(construction_keys, searched_construction_keys)
+        added_existing_keys = np.setdiff1d(existing_keys, searched_existing_keys)
+
+        logger.info(
+            f"{company_name}: searching {len(added_construction_keys)} new construction sites and "
+            f"{len(added_existing_keys)} new existing sites, reusing "
+            f"{0 if kept_pairs is None else len(kept_pairs['distances'])} pairs"
+        )
+
+        # new construction sites against every existing site, unchanged construction sites against the new existing sites
+        pair_blocks = [] if kept_pairs is None else [kept_pairs]
+        for search_construction_keys, search_existing_keys in [
+            (added_construction_keys, existing_keys),
+            (unchanged_construction_keys, added_existing_keys)
+        ]:
+            if len(search_construction_keys) and len(search_existing_keys):
+                pair_blocks.append(search_site_pairs(
+                    search_construction_keys.real,
+                    search_construction_keys.imag,
+                    search_existing_keys.real,
+                    search_existing_keys.imag,
+                    metro_coords_dict,
+                    build_threshold,
+                    distance_mode,
+                    distance_cache
+                ))
+
+        pairs = {
+            field: np.concatenate([pair_block[field] for pair_block in pair_blocks] + [np.empty(0)])
+            for field in PAIR_FIELDS
+        }
+        pairs['city_ids'] = pairs['city_ids'].astype(np.int64)
+
+        company_states[company_name] = dict(
+            pairs,
+            searched_construction_lats=construction_keys.real,
+            searched_construction_lons=construction_keys.imag,
+            searched_existing_lats=existing_keys.real,
+            searched_existing_lons=existing_keys.imag
+        )
+
+        site_matches = get_site_matches_from_pairs(
+            pairs,
+            construction_lats,
+            construction_lons,
+            existing_lats,
+            existing_lons
+        )
+
+        all_company_analysis_results[company_name] = count_company_interferences(
+            company_name,
+            construction_lats,
+            construction_lons,
+            site_arrays['construction_units'],
+            existing_lats,
+            existing_lons,
+            site_matches,
+            metro_coords_dict,
+            build_threshold=build_threshold,
+            city_threshold=city_threshold,
+            trace_every=trace_every
+        )
+
+    save_incremental_state(state_path, signature, company_states)
+    logger.info(f"saved the incremental state to {state_path}")
+
+    logger.info("analysis complete")
+
+    return all_company_analysis_results
+
+
+def iter_property_file_chunks(filename, columns, chunk_size=100000):
+    """
+        stream a CSV or Parquet property export as dataframes of at most chunk_size rows holding only
+        'columns', so files larger than memory can be processed. Parquet needs the optional pyarrow package
+    """
+    filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    logger.info(f"streaming {columns} from {filename} in chunks of {chunk_size} rows")
+
+    if os.path.splitext(filepath)[1].lower() in ['.parquet', '.pq']:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("reading parquet files requires pyarrow, install it with: pip install pyarrow")
+
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        # round trip parsing so coordinates match the exported values exactly (they are used as keys)
+        for chunk_df in pd.read_csv(filepath, usecols=columns, chunksize=chunk_size, float_precision='round_trip'):
+            yield chunk_df[columns]
+
+
+def read_construction_file(filename,
+                           construction_lat_key,
+                           construction_lon_key,
+                           num_units_key,
+                           company_key=None,
+                           chunk_size=100000):
+    """
+        read the construction sites of a CSV or Parquet export into {company: construction_df}. The
+        construction set is kept in memory (it is small next to the existing stock). Without a
+        company_key column every row belongs to one company named after the file
+    """
+    columns = [construction_lat_key, construction_lon_key, num_units_key]
+    if company_key is not None:
+        columns = [company_key] + columns
+
+    construction_df = pd.concat(
+        [chunk_df.dropna() for chunk_df in iter_property_file_chunks(filename, columns, chunk_size)],
+        ignore_index=True
+    )
+
+    if company_key is None:
+        company_name = os.path.splitext(os.path.basename(filename))[0]
+        return {company_name: construction_df}
+
+    return {
+        company_name: company_construction_df.drop(columns=[company_key])
+        for company_name, company_construction_df in construction_df.groupby(company_key, sort=False)
+    }
+
+
+def run_streaming(construction_df_dict,
+                  existing_chunks,
+                  metro_coords_dict,
+                  existing_lat_key,
+                  existing_lon_key,
+                  construction_lat_key,
+                  construction_lon_key,
+                  num_units_key,
+                  company_key=None,
+                  build_threshold=1,
+                  city_threshold=30,
+                  distance_mode='geodesic',
+                  trace_every=1,
+                  distance_cache=None):
+    """
+        the same analysis as run() for existing stock that does not fit in memory. 'existing_chunks'
+        yields dataframes of existing sites (e.g. iter_property_file_chunks) which are searched one at
+        a time against the in-memory construction_df_dict ({company: construction_df}, see
+        read_construction_file). Only the existing sites within build_threshold of a construction site
+        are kept between chunks, so peak memory is bounded by the chunk size plus the matches
+
+        the matches are counted in the original order at the end, so the results equal those of
+        run() on the same sites. Without a company_key column all existing sites belong to the
+        only company of construction_df_dict
+    """
+    logger.info("now running streaming property distance analysis")
+
+    if company_key is None:
+        assert len(construction_df_dict) == 1, "a company_key column is needed to stream more than one company"
+
+    # per company: the kept existing coordinates and, per construction site, the matches of every chunk
+    company_matches = {}
+    for company_name, construction_df in construction_df_dict.items():
+        construction_lats, construction_lons = get_coord_arrays(construction_df, construction_lat_key, construction_lon_key)
+        company_matches[company_name] = {
+            'construction_lats': construction_lats,
+            'construction_lons': construction_lons,
+            'construction_units': np.ascontiguousarray(construction_df[num_units_key].to_numpy(dtype=np.float64)),
+            'existing_lats': [],
+            'existing_lons': [],
+            'num_existing': 0,
+            'site_matches': [[] for _ in range(len(construction_df))]
+        }
+
+    num_chunks = 0
+    for chunk_df in existing_chunks:
+        num_chunks += 1
+        chunk_df = chunk_df.dropna()
+
+        if company_key is None:
+            company_chunks = [(next(iter(construction_df_dict)), chunk_df)]
+        else:
+            company_chunks = chunk_df.groupby(company_key, sort=False)
+
+        for company_name, company_chunk_df in company_chunks:
+
+            if company_name not in company_matches:
+                logger.debug(f"skipping existing sites of {company_name} since it has no construction sites")
                 continue
-    print("analysis complete")
+
+            matches = company_matches[company_name]
+            existing_lats, existing_lons = get_coord_arrays(company_chunk_df, existing_lat_key, existing_lon_key)
+
+            site_matches = search_construction_sites(
+                matches['construction_lats'],
+                matches['construction_lons'],
+                existing_lats,
+                existing_lons,
+                metro_coords_dict,
+                build_threshold,
+                distance_mode,
+                distance_cache,
+                city_threshold
+            )
+
+            # keep only the existing sites that matched, renumbered after the ones kept from earlier chunks
+            matched_idxs = np.unique(np.concatenate([site_match[0] for site_match in site_matches] + [np.empty(0, dtype=np.int64)]))
+            matches['existing_lats'].append(existing_lats[matched_idxs])
+            matches['existing_lons'].append(existing_lons[matched_idxs])
+
+            for cxn_pos, (neighbour_idxs, distances, min_dists, closest_city_ids) in enumerate(site_matches):
+                if len(neighbour_idxs):
+                    kept_idxs = matches['num_existing'] + np.searchsorted(matched_idxs, neighbour_idxs)
+                    matches['site_matches'][cxn_pos].append((kept_idxs, distances, min_dists, closest_city_ids))
+
+            matches['num_existing'] += len(matched_idxs)
+
+    logger.info(f"searched {num_chunks} chunks of existing sites")
+
+    all_company_analysis_results = {}
+
+    for company_name, matches in company_matches.items():
+
+        # join the matches of all chunks, which were streamed in the original order
+        site_matches = []
+        for chunk_matches in matches['site_matches']:
+            site_matches.append((
+                np.concatenate([m[0] for m in chunk_matches] + [np.empty(0, dtype=np.int64)]),
+                np.concatenate([m[1] for m in chunk_matches] + [np.empty(0)]),
+                np.concatenate([m[2] for m in chunk_matches] + [np.empty(0)]),
+                np.concatenate([m[3] for m in chunk_matches] + [np.empty(0, dtype=np.int64)])
+            ))
+
+        all_company_analysis_results[company_name] = count_company_interferences(
+            company_name,
+            matches['construction_lats'],
+            matches['construction_lons'],
+            matches['construction_units'],
+            np.concatenate(matches['existing_lats'] + [np.empty(0)]),
+            np.concatenate(matches['existing_lons'] + [np.empty(0)]),
+            site_matches,
+            metro_coords_dict,
+            build_threshold=build_threshold,
+            city_threshold=city_threshold,
+            trace_every=trace_every
+        )
+
+    logger.info("analysis complete")
 
     return all_company_analysis_results
 
 
+def load_service_snapshot(filename,
+                          metro_loc_file,
+                          existing_lat_key,
+                          existing_lon_key,
+                          construction_lat_key,
+                          construction_lon_key,
+                          num_units_key,
+                          build_threshold=1,
+                          city_threshold=30,
+                          variant='company',
+                          distance_mode='geodesic',
+                          workers=1,
+                          cache_dir=None,
+                          distance_cache=None):
+    """
+        read the inputs and run the analysis once for the service (see analysis_service.py), which
+        keeps the result in memory and calls this again whenever the workbook or the metro file change
+
+        the service reloads from its watcher thread, so the connection of the distance cache is closed
+        after every load and reopened by the next one. The distances in memory are kept across reloads
+    """
+    from analysis_service import ServiceSnapshot
+
+    metro_coords_dict = get_metro_coords_dict(metro_loc_file)
+    company_locs_dict = read_excel_file_to_dataframe(
+        filename,
+        existing_lat_key,
+        existing_lon_key,
+        construction_lat_key,
+        construction_lon_key,
+        num_units_key,
+        cache_dir=cache_dir)
+
+    try:
+        all_company_analysis_results = run(
+            company_locs_dict,
+            metro_coords_dict,
+            existing_lat_key,
+            existing_lon_key,
+            construction_lat_key,
+            construction_lon_key,
+            num_units_key,
+            build_threshold=build_threshold,
+            city_threshold=city_threshold,
+            variant=variant,
+            distance_mode=distance_mode,
+            workers=workers,
+            trace_every=0,
+            distance_cache=distance_cache
+        )
+    finally:
+        if distance_cache is not None:
+            distance_cache.close()
+
+    company_site_arrays = get_company_site_arrays(
+        company_locs_dict,
+        existing_lat_key,
+        existing_lon_key,
+        construction_lat_key,
+        construction_lon_key,
+        num_units_key)
+
+    return ServiceSnapshot(
+        metro_coords_dict,
+        company_site_arrays,
+        all_company_analysis_results,
+        build_threshold=build_threshold,
+        city_threshold=city_threshold
+    )
+
+
 def summarize_analysis(all_company_analysis_results):
     """
         get the average distance between existing and construction sites, sort by city
 
-        all_company_analysis_results[company_name] = {
-            'total_company_interferences': 0,  # rolling sum across all property owned by company
-            'construction_sites_counted': {},  # {(lat, lon) : bool is_counted } prevent double counting properties
-            'units_wip_by_city': {},  # track units in progress for company by city
-            'interferences_by_city': {},  # track interferences by city { city: { lat_lon (of construction site): [((elat, elon), dist, num_units)]}}
-            'all_distances': [],  # list of all distances between construction and existing sites
-            'interference_count_by_city': {} # track the number of interferences by city { city: int }
-        }
-
+        all_company_analysis_results[company_name] is the CompanyInterferences table of the
+        company (see results_store.py), every statistic is computed from its columns
     """
     summary_lines = []
 
     for company, company_results in all_company_analysis_results.items():
 
+        all_distances = company_results.get_distances()
+        interference_count_by_city = company_results.get_interference_counts_by_city()
+        units_wip_by_city = company_results.get_units_wip_by_city()
+
+        # argmax/argmin return the first city on ties, the same one max/min over the city dict gave
         summary_lines.append(f"======== results for company: {company} ========")
-        summary_lines.append("total interferences: " + str(company_results['total_company_interferences']))
-        #summary_lines.append("total units in progress: " + str(sum(company_results['units_wip_by_city'].values())))
-        summary_lines.append("average distance between existing and construction sites: " + str(np.average(np.asarray(company_results['all_distances']))) + " miles")
-        summary_lines.append("standard deviation of distance between existing and construction sites: " + str(np.std(np.asarray(company_results['all_distances']))) + " miles")
-        summary_lines.append("city with most interferences: " + max(company_results['interference_count_by_city'], key=company_results['interference_count_by_city'].get))
-        summary_lines.append("city with least interferences: " + min(company_results['interference_count_by_city'], key=company_results['interference_count_by_city'].get))
-        #city_to_cton_sites = {k: v for k, v in company_results['units_wip_by_city'].items()}
-        # print(f"city to cton sites: {city_to_cton_sites} ")
-        # city_to_total_units = {k: sum(v.values()) for k, v in city_to_cton_sites.items()}
-        # print(f"city to total units: {city_to_total_units} ")
-        summary_lines.append("city with most units in progress: " + max(company_results['units_wip_by_city'], key=company_results['units_wip_by_city'].get))
-        summary_lines.append("city with least units in progress: " + min(company_results['units_wip_by_city'], key=company_results['units_wip_by_city'].get))
+        summary_lines.append("total interferences: " + str(company_results.total_interferences))
+        summary_lines.append("average distance between existing and construction sites: " + str(np.average(all_distances)) + " miles")
+        summary_lines.append("standard deviation of distance between existing and construction sites: " + str(np.std(all_distances)) + " miles")
+        summary_lines.append("city with most interferences: " + company_results.city_names[np.argmax(interference_count_by_city)])
+        summary_lines.append("city with least interferences: " + company_results.city_names[np.argmin(interference_count_by_city)])
+        summary_lines.append("city with most units in progress: " + company_results.city_names[np.argmax(units_wip_by_city)])
+        summary_lines.append("city with least units in progress: " + company_results.city_names[np.argmin(units_wip_by_city)])
+
+        # cross company results (variant 'total'): who builds near whose existing sites
+        if company_results.company_names is not None:
+            interference_count_by_company = company_results.get_interference_counts_by_company()
+            for cxn_company_id, cxn_company in enumerate(company_results.company_names):
+                for exst_company_id, exst_company in enumerate(company_results.company_names):
+                    summary_lines.append(
+                        f"interferences of {cxn_company} construction with {exst_company} existing sites: "
+                        f"{interference_count_by_company[cxn_company_id, exst_company_id]}"
+                    )
         summary_lines.append("\n\n")
     
     # write summary lines to text file
     fname = "./analysis_summary.txt"
     with open(fname, 'w') as f:
         f.write("\n".join(summary_lines))
-    print(f"wrote to {fname}")
+    logger.info(f"wrote to {fname}")
 
 
-def write_results_to_json(all_company_analysis_results):
-    import json
-    # write each company's results to json named after the company with indent of 4
-    for company, company_results in all_company_analysis_results.items():
-        fname = f"./companies/{company}_analysis_results.json"
-        with open(fname, 'w') as f:
-            json.dump(company_results, f, indent=4)
-        print(f"wrote to {fname}")
+def summarize_threshold_sweep(sweep_results, fname="./threshold_sweep.json"):
+    """
+        one row per combination of thresholds and company with the interference count, units in
+        progress and distance statistics, written to 'fname'. Distance statistics are None for
+        combinations without interferences
+    """
+    sweep_rows = []
+    for (build_threshold, city_threshold), all_company_analysis_results in sweep_results.items():
+        for company, company_results in all_company_analysis_results.items():
+            all_distances = company_results.get_distances()
+            sweep_rows.append({
+                'build_threshold': build_threshold,
+                'city_threshold': city_threshold,
+                'company': company,
+                'total_interferences': company_results.total_interferences,
+                'total_units_wip': company_results.get_total_units_wip(),
+                'average_distance': float(np.average(all_distances)) if len(all_distances) else None,
+                'std_distance': float(np.std(all_distances)) if len(all_distances) else None,
+                'interference_count_by_city': dict(zip(company_results.city_names, company_results.get_interference_counts_by_city().tolist())),
+                'units_wip_by_city': dict(zip(company_results.city_names, company_results.get_units_wip_by_city().tolist()))
+            })
+
+    with open(fname, 'wb') as f:
+        f.write(dumps_json(sweep_rows, 'pretty'))
+    logger.info(f"wrote to {fname}")
+
+    return sweep_rows
+
+
+def write_results_to_json(all_company_analysis_results, results_format='pretty'):
+    """
+        write the results of every company to ./companies/<company>_analysis_results.json and all
+        companies to ./all_analysis_results.json (see results_writer.py)
+
+        results_format 'pretty' keeps the original indented files, 'compact' writes the same documents
+        without whitespace (with orjson when installed) and 'ndjson' writes one interference per line
+        to ./all_analysis_results.ndjson instead, which results_writer.iter_ndjson_results streams back
+    """
+    if results_format not in RESULTS_FORMATS:
+        raise ValueError(f"unknown results format '{results_format}', expected one of {RESULTS_FORMATS}")
+
+    if results_format == 'ndjson':
+        written_paths = write_ndjson_results(all_company_analysis_results, "./all_analysis_results.ndjson")
+    else:
+        written_paths = write_json_results(
+            all_company_analysis_results,
+            companies_dir="./companies",
+            all_results_path="./all_analysis_results.json",
+            results_format=results_format
+        )
+
+    for fname in written_paths:
+        logger.info(f"wrote to {fname}")
 
 
 def map_all_results(metro_coord_dict,
@@ -397,13 +1458,52 @@ def map_all_results(metro_coord_dict,
                     existing_lat_key, 
                     existing_lon_key,
                     build_threshold=1,
-                    city_threshold=30):
+                    city_threshold=30,
+                    render_mode='markers',
+                    sidecar_dir=None,
+                    map_path="./all_analysis_map.html"):
     """
         This function uses information produced from the run function in order
         to visualize the distances between the cities of interest;
         Make sure to plot all construction and all existing draw small circles around
+
+        render_mode 'markers' adds one folium object per site. 'clustered' builds batch layers from
+        the coordinate arrays (see map_layers): clustered construction markers and one GeoJson layer
+        of existing sites per company, each company toggleable in the layer control. With
+        'clustered', sidecar_dir writes the existing sites to GeoJson files next to the map that the
+        page loads when opened (serve the folder over http, browsers block loading local files)
     """
-    print("in map all results function")
+    logger.info("in map all results function")
+
+    import folium
+
+    from map_layers import MAP_RENDER_MODES, add_company_layer, add_metro_layer
+
+    if render_mode not in MAP_RENDER_MODES:
+        raise ValueError(f"unknown render mode '{render_mode}', expected one of {MAP_RENDER_MODES}")
+
+    if render_mode == 'clustered':
+        # canvas draws thousands of circles much faster than one svg element per circle
+        m = folium.Map(zoom_start=8, tiles='OpenStreetMap', csr="EPSG4326", prefer_canvas=True)
+
+        add_metro_layer(m, metro_coord_dict, city_threshold=city_threshold)
+
+        map_dir = os.path.dirname(map_path) or "."
+        for company, company_locs in company_locs_dict.items():
+            add_company_layer(
+                m,
+                company,
+                *get_coord_arrays(company_locs['construction'], construction_lat_key, construction_lon_key),
+                *get_coord_arrays(company_locs['existing'], existing_lat_key, existing_lon_key),
+                build_threshold=build_threshold,
+                map_dir=map_dir,
+                sidecar_dir=sidecar_dir
+            )
+
+        folium.LayerControl(collapsed=False).add_to(m)
+        m.save(map_path)
+
+        return m
 
     m = folium.Map(zoom_start=8, tiles='OpenStreetMap', csr="EPSG4326")
 
@@ -421,24 +1521,24 @@ def map_all_results(metro_coord_dict,
 
     for company, company_locs in company_locs_dict.items():
 
-        construction_df = company_locs['construction']
-        for c_index, crow in construction_df.iterrows():
-            construction_lat = crow[construction_lat_key]
-            construction_lon = crow[construction_lon_key]
+        construction_lats, construction_lons = get_coord_arrays(company_locs['construction'], construction_lat_key, construction_lon_key)
+
+        # np.round rounds like the numpy scalars the markers were placed with before
+        for construction_lat, construction_lon, rounded_lat, rounded_lon in zip(
+                construction_lats.tolist(),
+                construction_lons.tolist(),
+                np.round(construction_lats, 3).tolist(),
+                np.round(construction_lons, 3).tolist()):
             folium.Marker(
-                location= [round(construction_lat, 3), round(construction_lon, 3)],
+                location= [rounded_lat, rounded_lon],
                 #radius=build_limit,
                 fill=True,
                 icon=folium.Icon(color='red', icon=''),
                 popup= f"construction location ({construction_lat},{construction_lon})"   # f"{unit_count} units in progress",
             ).add_to(m)
 
-        existing_df = company_locs['existing']
-        for e_index, erow in existing_df.iterrows():
-
-            # obtain the coordinates from current df location
-            existing_lat = erow[existing_lat_key]
-            existing_lon = erow[existing_lon_key]
+        existing_lats, existing_lons = get_coord_arrays(company_locs['existing'], existing_lat_key, existing_lon_key)
+        for existing_lat, existing_lon in zip(existing_lats.tolist(), existing_lons.tolist()):
 
             folium.Circle(
                 location= [existing_lat, existing_lon],
@@ -448,32 +1548,129 @@ def map_all_results(metro_coord_dict,
                 fill=False,
             ).add_to(m)
 
-    m.save("./all_analysis_map.html")
+    m.save(map_path)
     
     return m
 
-def zoom_save_map_by_location(map, metro_coords_dict):
-    """ zoom the overall map to each of the metro coordinates in the metro_coords dict and save each snapshot
-        by city name
+def zoom_save_map_by_location(metro_coords_dict,
+                              company_locs_dict,
+                              construction_lat_key,
+                              construction_lon_key,
+                              existing_lat_key,
+                              existing_lon_key,
+                              build_threshold=1,
+                              city_threshold=30,
+                              distance_mode='geodesic',
+                              workers=1,
+                              maps_dir="./maps"):
+    """ save a map of each of the metro coordinates in the metro_coords dict to
+        <maps_dir>/<city>_analysis_map.html
+
+        every map only holds the sites within city_threshold of its metro. They are found with a
+        radius query on a spatial index of each company's sites instead of filtering the whole
+        national map, and with workers > 1 the maps are rendered in a process pool
     """
-    print(metro_coords_dict)
-    # for each city in metro_coords_dict, zoom the map to that location and save the map
-    # for city, coord in metro_coords_dict.items():
-    #     city_lat = float(coord[0])
-    #     city_lon = float(coord[1])
-    #     map.zoom_start = 12
-    #     map.location = [city_lat, city_lon]
-    #     map.save(f"./maps/{city}_analysis_map.html")
+    logger.info(f"saving {len(metro_coords_dict)} metro maps to {maps_dir}")
+
+    from map_layers import save_metro_map
+
+    os.makedirs(maps_dir, exist_ok=True)
+
+    # the cell size only affects speed, a fraction of the query radius keeps the candidate sets tight
+    cell_size_mi = max(city_threshold / 4, 1)
+    company_indexes = {}
+    for company, company_locs in company_locs_dict.items():
+        company_indexes[company] = (
+            SpatialGridIndex(*get_coord_arrays(company_locs['construction'], construction_lat_key, construction_lon_key),
+                             cell_size_mi=cell_size_mi),
+            SpatialGridIndex(*get_coord_arrays(company_locs['existing'], existing_lat_key, existing_lon_key),
+                             cell_size_mi=cell_size_mi)
+        )
+
+    map_tasks = []
+    for city, coord in metro_coords_dict.items():
+        city_lat = float(coord[0])
+        city_lon = float(coord[1])
 
+        company_sites = {}
+        for company, (construction_index, existing_index) in company_indexes.items():
+            construction_idxs = construction_index.query_radius(city_lat, city_lon, city_threshold, distance_mode)[0]
+            existing_idxs = existing_index.query_radius(city_lat, city_lon, city_threshold, distance_mode)[0]
+            company_sites[company] = (
+                construction_index.lats[construction_idxs],
+                construction_index.lons[construction_idxs],
+                existing_index.lats[existing_idxs],
+                existing_index.lons[existing_idxs]
+            )
 
+        map_path = os.path.join(maps_dir, f"{city}_analysis_map.html")
+        map_tasks.append((city, (city_lat, city_lon), company_sites, map_path, build_threshold, city_threshold))
 
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
 
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            map_paths = list(pool.map(save_metro_map, *zip(*map_tasks)))
+    else:
+        map_paths = [save_metro_map(*task) for task in map_tasks]
 
+    logger.info(f"saved {len(map_paths)} metro maps")
 
+    return map_paths
 
 
 if __name__ == "__main__":
 
+    import argparse
+
+    parser = argparse.ArgumentParser(description="construction and existing property interference analysis")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG adds the per pair diagnostics of the analysis")
+    parser.add_argument("--trace-every", type=int, default=1,
+                        help="with --log-level DEBUG, only trace every n-th construction site (0 turns the trace off)")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="parse the workbook again and rewrite the ingest cache")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse the pairs of the previous run and only search sites that were added or moved")
+    parser.add_argument("--existing-file", default=None,
+                        help="stream the existing sites from this CSV/Parquet file instead of reading the workbook")
+    parser.add_argument("--construction-file", default=None,
+                        help="CSV/Parquet file with the construction sites, used with --existing-file")
+    parser.add_argument("--company-key", default=None,
+                        help="column with the company name in the CSV/Parquet files")
+    parser.add_argument("--chunk-size", type=int, default=100000,
+                        help="number of existing sites per streamed chunk")
+    parser.add_argument("--results-format", default="pretty", choices=["pretty", "compact", "ndjson"],
+                        help="pretty and compact write the json files, ndjson one interference per line")
+    parser.add_argument("--no-distance-cache", action="store_true",
+                        help="compute every distance instead of reusing the distance cache of earlier runs")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every stage and inner loop helper, write the report to profile_report.json")
+    parser.add_argument("--profile-company", action="append", default=None,
+                        help="also run this company under cProfile (repeatable), stats go to profile_<company>.prof")
+    parser.add_argument("--sweep-build-thresholds", type=float, nargs="+", default=None,
+                        help="write the results for each of these build thresholds to threshold_sweep.json instead")
+    parser.add_argument("--sweep-city-thresholds", type=float, nargs="+", default=None,
+                        help="write the results for each of these city thresholds to threshold_sweep.json instead")
+    parser.add_argument("--analysis-only", action="store_true",
+                        help="write the summary and json results but no maps, folium is never imported")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep the inputs and indexes in memory and answer queries over http (see analysis_service.py)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address the service listens on")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port the service listens on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.profile or args.profile_company:
+        import atexit
+
+        profiler = Profiler(profile_companies=args.profile_company).activate()
+        # written at exit so the modes that end the run early are reported as well
+        atexit.register(profiler.write_report)
+
     """
         REPLACE THE NAMES OF THE EXCEL COLUMNS HERE AS NEEDED
     """
@@ -485,59 +1682,243 @@ if __name__ == "__main__":
     construction_lon_key = 'CLon'  # construction longitude key
     num_units_key = 'num units'
 
+    # 'company' checks every company against its own existing sites, 'total' checks the construction
+    # of every company against the existing sites of all companies (competitor encroachment)
+    variant = 'company'
+
     build_threshold = 3  # distance from construction to any existing site to be considered an interference
     city_threshold = 50  # distance from current location to closest city to be considered further
 
+    # how distances are measured: 'geodesic' (exact, same as geopy), 'vincenty' (vectorized ellipsoid)
+    # or 'haversine' (vectorized sphere, fastest). distance_engine.distance_mode_errors reports the
+    # maximum error of each mode against geopy for a set of points to help choose
+    distance_mode = 'geodesic'
+
+    # number of processes used to search the companies and chunks of construction sites in parallel
+    # the results are the same for any number of workers
+    workers = 1
+
     # replace with your filename
     filename = "./cities_locations.xlsx"
 
-    # convert the excel file into a dataframe that is easier to process
-    # the `company_locs_dict` is a dictionary of the form {company_name : {'construction': df, 'existing': df}}
-    # each company has its own entry in this dictionary and each company entry has a construction and existing dataframe associated to it
-    company_locs_dict = read_excel_file_to_dataframe(
-        filename,
-        existing_lat_key,
-        existing_lon_key,
-        construction_lat_key,
-        construction_lon_key,
-        num_units_key)
+    # metro names and coordinates, one "City:lat,lon" per line
+    metro_loc_file = "largest_metros.txt"
 
-    # obtain the coordinates of each of 30 major metro cities (add to this list as needed)
-    # format of the metro_coords_dict is {(lat, lon) : city} track city locations by their coordinates
-    # this is used later as a cheap reference to other city locations without 3rd party dependencies
-    metro_coords_dict = get_metro_coords_dict()
+    # the cleaned dataframes are cached here so later runs do not parse the workbook again
+    # (set to None to always read the workbook)
+    cache_dir = "./.ingest_cache"
 
-    # run the analysis 
-    all_company_analysis_results = run(
-        company_locs_dict,
-        metro_coords_dict,
-        existing_lat_key,
-        existing_lon_key,
-        construction_lat_key,
-        construction_lon_key,
-        num_units_key,
-        build_threshold=build_threshold,
-        city_threshold=city_threshold
-    )
+    # pairs found by the previous run, reused with --incremental
+    incremental_state_path = "./.incremental_state.npz"
 
-    summarize_analysis(all_company_analysis_results)
+    # distances computed by earlier runs are kept here and reused (see distance_cache.py). The most recent
+    # distance_cache_size distances are also kept in memory and the store keeps the last distance_cache_stored
+    # written. Only used for 'geodesic', the vectorized modes compute a distance faster than the cache can look it up
+    distance_cache_path = "./.distance_cache.sqlite"
+    distance_cache_size = 1000000
+    distance_cache_stored = 20000000
 
-    write_results_to_json(all_company_analysis_results)
+    # how the map is drawn: 'clustered' (batch layers, scales to large portfolios) or 'markers'
+    # (one marker or circle per site). With 'clustered', set map_sidecar_dir to a folder to write
+    # the existing sites there as GeoJson instead of inlining them in the html
+    map_render_mode = 'clustered'
+    map_sidecar_dir = None
 
-    print("mapping results")
+    # obtain the coordinates of each of 30 major metro cities (add to this list as needed)
+    # format of the metro_coords_dict is {(lat, lon) : city} track city locations by their coordinates
+    # this is used later as a cheap reference to other city locations without 3rd party dependencies
+    metro_coords_dict = get_metro_coords_dict(metro_loc_file)
+
+    distance_cache = None
+    if not args.no_distance_cache and distance_mode == 'geodesic':
+        distance_cache = DistanceCache(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), distance_cache_path),
+            max_entries=distance_cache_size,
+            max_stored=distance_cache_stored)
+
+    if variant == 'total' and (args.incremental or args.existing_file is not None
+                               or args.sweep_build_thresholds is not None or args.sweep_city_thresholds is not None):
+        parser.error("variant 'total' is only supported by the full analysis of the workbook")
+
+    if args.serve:
+        from analysis_service import AnalysisService, serve
+
+        # the workbook and the metro file are watched and reloaded when they change
+        service = AnalysisService(
+            lambda: load_service_snapshot(
+                filename,
+                metro_loc_file,
+                existing_lat_key,
+                existing_lon_key,
+                construction_lat_key,
+                construction_lon_key,
+                num_units_key,
+                build_threshold=build_threshold,
+                city_threshold=city_threshold,
+                variant=variant,
+                distance_mode=distance_mode,
+                workers=workers,
+                cache_dir=cache_dir,
+                distance_cache=distance_cache),
+            [os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)), os.path.abspath(metro_loc_file)],
+            distance_mode=distance_mode)
+        serve(service, host=args.host, port=args.port)
+        sys.exit(0)
+
+    if args.existing_file is not None:
+
+        if args.construction_file is None:
+            parser.error("--existing-file needs --construction-file")
+
+        # stream the existing sites chunk by chunk against the construction sites held in memory
+        with stage('ingest'):
+            construction_df_dict = read_construction_file(
+                args.construction_file,
+                construction_lat_key,
+                construction_lon_key,
+                num_units_key,
+                company_key=args.company_key,
+                chunk_size=args.chunk_size)
+
+        existing_columns = [existing_lat_key, existing_lon_key]
+        if args.company_key is not None:
+            existing_columns = [args.company_key] + existing_columns
+
+        with stage('analysis'):
+            all_company_analysis_results = run_streaming(
+                construction_df_dict,
+                iter_property_file_chunks(args.existing_file, existing_columns, chunk_size=args.chunk_size),
+                metro_coords_dict,
+                existing_lat_key,
+                existing_lon_key,
+                construction_lat_key,
+                construction_lon_key,
+                num_units_key,
+                company_key=args.company_key,
+                build_threshold=build_threshold,
+                city_threshold=city_threshold,
+                distance_mode=distance_mode,
+                trace_every=args.trace_every,
+                distance_cache=distance_cache
+            )
+
+        # the streamed existing sites are not kept in memory, so there is nothing to map
+        company_locs_dict = None
+
+    else:
+
+        # convert the excel file into a dataframe that is easier to process
+        # the `company_locs_dict` is a dictionary of the form {company_name : {'construction': df, 'existing': df}}
+        # each company has its own entry in this dictionary and each company entry has a construction and existing dataframe associated to it
+        with stage('ingest'):
+            company_locs_dict = read_excel_file_to_dataframe(
+                filename,
+                existing_lat_key,
+                existing_lon_key,
+                construction_lat_key,
+                construction_lon_key,
+                num_units_key,
+                cache_dir=cache_dir,
+                rebuild_cache=args.rebuild_cache)
+
+        if args.sweep_build_thresholds is not None or args.sweep_city_thresholds is not None:
+            # every combination of thresholds from one search, a threshold that is not swept keeps its value below
+            with stage('analysis'):
+                sweep_results = run_threshold_sweep(
+                    company_locs_dict,
+                    metro_coords_dict,
+                    existing_lat_key,
+                    existing_lon_key,
+                    construction_lat_key,
+                    construction_lon_key,
+                    num_units_key,
+                    args.sweep_build_thresholds or [build_threshold],
+                    args.sweep_city_thresholds or [city_threshold],
+                    distance_mode=distance_mode,
+                    workers=workers,
+                    distance_cache=distance_cache
+                )
+            summarize_threshold_sweep(sweep_results)
+            sys.exit(0)
+
+        # run the analysis 
+        with stage('analysis'):
+            if args.incremental:
+                all_company_analysis_results = run_incremental(
+                    company_locs_dict,
+                    metro_coords_dict,
+                    existing_lat_key,
+                    existing_lon_key,
+                    construction_lat_key,
+                    construction_lon_key,
+                    num_units_key,
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)), incremental_state_path),
+                    build_threshold=build_threshold,
+                    city_threshold=city_threshold,
+                    distance_mode=distance_mode,
+                    trace_every=args.trace_every,
+                    distance_cache=distance_cache
+                )
+            else:
+                all_company_analysis_results = run(
+                    company_locs_dict,
+                    metro_coords_dict,
+                    existing_lat_key,
+                    existing_lon_key,
+                    construction_lat_key,
+                    construction_lon_key,
+                    num_units_key,
+                    build_threshold=build_threshold,
+                    city_threshold=city_threshold,
+                    variant=variant,
+                    distance_mode=distance_mode,
+                    workers=workers,
+                    trace_every=args.trace_every,
+                    distance_cache=distance_cache
+                )
+
+    with stage('summarize'):
+        summarize_analysis(all_company_analysis_results)
+
+    with stage('json_write'):
+        write_results_to_json(all_company_analysis_results, results_format=args.results_format)
+
+    if company_locs_dict is None:
+        logger.info("skipping the map for streamed input")
+        sys.exit(0)
+
+    if args.analysis_only:
+        logger.info("skipping the maps (--analysis-only)")
+        sys.exit(0)
+
+    logger.info("mapping results")
     
     # map the locations
-    final_map = map_all_results(
-        metro_coords_dict,
-        company_locs_dict,
-        construction_lat_key,
-        construction_lon_key, 
-        existing_lat_key, 
-        existing_lon_key,
-        build_threshold=build_threshold,
-        city_threshold=city_threshold
-    )
+    with stage('map_render'):
+        final_map = map_all_results(
+            metro_coords_dict,
+            company_locs_dict,
+            construction_lat_key,
+            construction_lon_key, 
+            existing_lat_key, 
+            existing_lon_key,
+            build_threshold=build_threshold,
+            city_threshold=city_threshold,
+            render_mode=map_render_mode,
+            sidecar_dir=map_sidecar_dir
+        )
     
-    # # save each zoomed map by city
-    # zoom_save_map_by_location(final_map, metro_coords_dict)
-
+    # save a map zoomed to each city
+    with stage('metro_maps'):
+        zoom_save_map_by_location(
+            metro_coords_dict,
+            company_locs_dict,
+            construction_lat_key,
+            construction_lon_key,
+            existing_lat_key,
+            existing_lon_key,
+            build_threshold=build_threshold,
+            city_threshold=city_threshold,
+            distance_mode=distance_mode,
+            workers=workers
+        )
@@ -0,0 +1,68 @@
+import json
+import os
+
+import numpy as np
+
+# bump when the layout of the state file changes so old states are ignored
+STATE_VERSION = 1
+
+# one row per (construction site, existing site) pair within build_threshold, keyed by the coordinates
+# of both sites (their fingerprint). Everything the counting step needs about a pair is kept, so pairs
+# of unchanged sites never have to be searched again
+PAIR_FIELDS = ['construction_lats', 'construction_lons', 'existing_lats', 'existing_lons', 'distances', 'min_city_dists', 'city_ids']
+
+# the (unique) coordinates of the sites that were searched, including those without any pair
+SITE_FIELDS = ['searched_construction_lats', 'searched_construction_lons', 'searched_existing_lats', 'searched_existing_lons']
+
+STATE_FIELDS = PAIR_FIELDS + SITE_FIELDS
+
+
+def get_state_signature(metro_coords_dict, build_threshold, distance_mode):
+    """
+        everything the stored pairs depend on. A state saved with a different signature is not reused
+    """
+    return {
+        'version': STATE_VERSION,
+        'build_threshold': build_threshold,
+        'distance_mode': distance_mode,
+        'metros': [[city_name, float(coords[0]), float(coords[1])] for city_name, coords in metro_coords_dict.items()]
+    }
+
+
+def load_incremental_state(state_path, signature):
+    """
+        the stored {company: {field: array}} of the previous run (see STATE_FIELDS), or an empty
+        dict when there is no state file or it was written with a different signature
+    """
+    if state_path is None or not os.path.exists(state_path):
+        return {}
+
+    try:
+        with np.load(state_path, allow_pickle=False) as state:
+            manifest = json.loads(str(state['manifest']))
+            if manifest['signature'] != signature:
+                return {}
+
+            return {
+                company_name: {field: state[f"{company_idx}_{field}"] for field in STATE_FIELDS}
+                for company_idx, company_name in enumerate(manifest['companies'])
+            }
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def save_incremental_state(state_path, signature, company_states):
+    """
+        store the pairs and searched sites of every company for the next incremental run
+    """
+    manifest = {'signature': signature, 'companies': list(company_states.keys())}
+
+    arrays = {'manifest': np.array(json.dumps(manifest))}
+    for company_idx, company_state in enumerate(company_states.values()):
+        for field in STATE_FIELDS:
+            arrays[f"{company_idx}_{field}"] = company_state[field]
+
+    # np.savez adds .npz to names without it, so write to a name that already ends with it and swap it in
+    tmp_path = state_path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, state_path)
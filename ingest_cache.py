@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# bump when the layout of the cache files changes so old caches are rebuilt
+CACHE_VERSION = 1
+
+FRAME_NAMES = ['construction', 'existing']
+
+
+def get_file_sha256(filepath, block_size=1 << 20):
+    """
+        sha256 hex digest of the file contents, read in blocks so large workbooks are not loaded at once
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def get_cache_folder(filepath, cache_dir):
+    """
+        every workbook gets its own folder inside the cache directory
+    """
+    return os.path.join(cache_dir, os.path.basename(filepath) + ".cache")
+
+
+def _read_manifest(cache_folder):
+    manifest_path = os.path.join(cache_folder, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(cache_folder, manifest):
+    # write next to the final file and swap it in so a crash never leaves a half written manifest
+    manifest_path = os.path.join(cache_folder, "manifest.json")
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_cached_frames(filepath, cache_dir, column_keys):
+    """
+        the cleaned {company: {'construction': df, 'existing': df}} dictionary from the cache, or None
+        when there is no cache for the workbook or it is stale
+
+        the cache is valid when the workbook modification time and size are unchanged, or when they
+        changed but the sha256 of the contents did not (e.g. the file was copied or touched).
+        columns are memory mapped from .npy files instead of parsing the workbook
+    """
+    cache_folder = get_cache_folder(filepath, cache_dir)
+    manifest = _read_manifest(cache_folder)
+
+    if manifest is None or manifest.get('version') != CACHE_VERSION or manifest.get('column_keys') != column_keys:
+        return None
+
+    stat = os.stat(filepath)
+    if manifest['mtime_ns'] != stat.st_mtime_ns or manifest['size'] != stat.st_size:
+        if manifest['sha256'] != get_file_sha256(filepath):
+            return None
+
+        # same contents with a new modification time, remember it so the next run skips the hash
+        manifest['mtime_ns'] = stat.st_mtime_ns
+        manifest['size'] = stat.st_size
+        _write_manifest(cache_folder, manifest)
+
+    company_df_clean_dict = {}
+    try:
+        for company_entry in manifest['companies']:
+            company_df_clean_dict[company_entry['name']] = {}
+            for frame_name in FRAME_NAMES:
+                frame_entry = company_entry[frame_name]
+                index = np.load(os.path.join(cache_folder, frame_entry['index']), mmap_mode='r')
+                columns = {
+                    column_name: np.load(os.path.join(cache_folder, column_file), mmap_mode='r')
+                    for column_name, column_file in frame_entry['columns']
+                }
+                # copy=False keeps every column backed by its memory map instead of reading it into memory
+                company_df_clean_dict[company_entry['name']][frame_name] = pd.DataFrame(columns, index=index, copy=False)
+    except (OSError, KeyError, ValueError):
+        # a cache file went missing or is corrupt, treat the whole cache as stale
+        return None
+
+    return company_df_clean_dict
+
+
+def save_cached_frames(filepath, cache_dir, column_keys, company_df_clean_dict):
+    """
+        store the cleaned frames of every company as one .npy file per column, keyed by the
+        workbook modification time, size and sha256. Files of older caches are removed
+    """
+    cache_folder = get_cache_folder(filepath, cache_dir)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    stat = os.stat(filepath)
+    sha256 = get_file_sha256(filepath)
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'workbook': os.path.basename(filepath),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': sha256,
+        'column_keys': column_keys,
+        'companies': []
+    }
+
+    written_files = set()
+    for company_idx, (company_name, frames) in enumerate(company_df_clean_dict.items()):
+        company_entry = {'name': company_name}
+        for frame_name in FRAME_NAMES:
+            frame_df = frames[frame_name]
+            prefix = f"{sha256[:16]}_{company_idx}_{frame_name}"
+
+            index_file = f"{prefix}_index.npy"
+            np.save(os.path.join(cache_folder, index_file), frame_df.index.to_numpy())
+            written_files.add(index_file)
+
+            # column names can be any string, so files are named by position
+            column_files = []
+            for column_idx, column_name in enumerate(frame_df.columns):
+                column_file = f"{prefix}_{column_idx}.npy"
+                np.save(os.path.join(cache_folder, column_file), frame_df[column_name].to_numpy())
+                column_files.append([column_name, column_file])
+                written_files.add(column_file)
+
+            company_entry[frame_name] = {'index': index_file, 'columns': column_files}
+        manifest['companies'].append(company_entry)
+
+    _write_manifest(cache_folder, manifest)
+
+    # remove the column files of previous versions of the workbook
+    for fname in os.listdir(cache_folder):
+        if fname.endswith(".npy") and fname not in written_files:
+            os.remove(os.path.join(cache_folder, fname))
+
+    return cache_folder
@@ -0,0 +1,175 @@
+import json
+import os
+
+import folium
+import numpy as np
+from branca.element import MacroElement
+from folium.plugins import FastMarkerCluster
+from jinja2 import Template
+
+MAP_RENDER_MODES = ['markers', 'clustered']
+
+# coordinates are written with 6 decimals (~0.1 m), plenty for a map and about half the characters of a float repr
+COORD_DECIMALS = 6
+
+# builds the construction markers in the browser from the [lat, lon] rows of a FastMarkerCluster,
+# so the popup text does not have to be stored once per site
+CONSTRUCTION_MARKER_CALLBACK = """
+    function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]));
+        marker.setIcon(L.AwesomeMarkers.icon({markerColor: 'red', icon: ''}));
+        marker.bindPopup("construction location (" + row[0] + "," + row[1] + ")");
+        return marker;
+    }"""
+
+
+class SidecarLoader(MacroElement):
+    """
+        fetches a GeoJson sidecar file without blocking the page and adds its features to a GeoJson
+        layer when they arrive (the layer's <name>_add function), so the map opens before the points load
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        fetch({{ this.link|tojson }})
+            .then(function (response) { return response.json(); })
+            .then({{ this.layer.get_name() }}_add);
+        {% endmacro %}
+    """)
+
+    def __init__(self, layer, link):
+        super().__init__()
+        self._name = 'SidecarLoader'
+        self.layer = layer
+        self.link = link
+
+
+def get_points_geojson(lats, lons, properties=None):
+    """
+        FeatureCollection with one Point feature per location. 'properties' is added to every feature
+    """
+    coords = np.round(np.stack([np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)], axis=1), COORD_DECIMALS)
+    feature_properties = properties or {}
+
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': feature_properties, 'geometry': {'type': 'Point', 'coordinates': coord}}
+            for coord in coords.tolist()
+        ]
+    }
+
+
+def write_geojson(path, geojson):
+    """
+        write compact geojson (no indentation or spaces), creating the folder when needed
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(geojson, f, separators=(',', ':'))
+
+
+def get_points_layer(geojson, name, marker, popup=None, map_dir=".", sidecar_path=None):
+    """
+        GeoJson layer drawing every point with 'marker'. Without a sidecar path the points are embedded
+        in the html. With one they are written to that file, the layer starts empty and the page
+        fetches the file asynchronously once it is opened (see SidecarLoader), which keeps the html the
+        same size for any number of points
+    """
+    if sidecar_path is None:
+        return folium.GeoJson(geojson, name=name, marker=marker, popup=popup, control=False)
+
+    write_geojson(sidecar_path, geojson)
+    layer = folium.GeoJson(get_points_geojson([], []), name=name, marker=marker, popup=popup, control=False)
+
+    # the page needs the file relative to the html
+    SidecarLoader(layer, os.path.relpath(sidecar_path, map_dir).replace(os.sep, "/")).add_to(layer)
+
+    return layer
+
+
+def add_metro_layer(m, metro_coords_dict, city_threshold=30):
+    """
+        city_threshold circles around every metro as one toggleable layer
+    """
+    metro_layer = folium.FeatureGroup(name="metros")
+
+    metro_coords = np.array([coords for coords in metro_coords_dict.values()], dtype=np.float64).reshape(-1, 2)
+    get_points_layer(
+        get_points_geojson(metro_coords[:, 0], metro_coords[:, 1], {'popup': f"{city_threshold} mi radius"}),
+        "metros",
+        folium.Circle(radius=1609 * city_threshold, color='green', fill=False),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False)
+    ).add_to(metro_layer)
+
+    metro_layer.add_to(m)
+
+    return metro_layer
+
+
+def add_company_layer(m,
+                      company,
+                      construction_lats,
+                      construction_lons,
+                      existing_lats,
+                      existing_lons,
+                      build_threshold=1,
+                      map_dir=".",
+                      sidecar_dir=None):
+    """
+        one toggleable layer per company. Construction sites are clustered markers built from the
+        coordinate arrays (FastMarkerCluster), existing sites are build_threshold circles from a
+        single GeoJson layer. With a sidecar folder the existing sites are written to
+        <sidecar_dir>/<company>_existing.geojson instead of the html
+    """
+    company_layer = folium.FeatureGroup(name=company)
+
+    construction_coords = np.round(
+        np.stack([np.asarray(construction_lats, dtype=np.float64), np.asarray(construction_lons, dtype=np.float64)], axis=1),
+        COORD_DECIMALS
+    )
+    FastMarkerCluster(construction_coords.tolist(), callback=CONSTRUCTION_MARKER_CALLBACK, control=False).add_to(company_layer)
+
+    sidecar_path = None if sidecar_dir is None else os.path.join(sidecar_dir, f"{company}_existing.geojson")
+    get_points_layer(
+        get_points_geojson(existing_lats, existing_lons),
+        f"{company} existing",
+        folium.Circle(radius=1609 * build_threshold, color='blue', fill=False),
+        map_dir=map_dir,
+        sidecar_path=sidecar_path
+    ).add_to(company_layer)
+
+    company_layer.add_to(m)
+
+    return company_layer
+
+
+def save_metro_map(city,
+                   city_coords,
+                   company_sites,
+                   map_path,
+                   build_threshold=1,
+                   city_threshold=30):
+    """
+        render and save the map of one metro, centered on it. company_sites is
+        {company: (construction_lats, construction_lons, existing_lats, existing_lons)} holding only
+        the sites around the metro, so the file only contains what is visible around the city
+    """
+    m = folium.Map(location=list(city_coords), zoom_start=10, tiles='OpenStreetMap', prefer_canvas=True)
+
+    add_metro_layer(m, {city: city_coords}, city_threshold=city_threshold)
+    for company, (construction_lats, construction_lons, existing_lats, existing_lons) in company_sites.items():
+        add_company_layer(
+            m,
+            company,
+            construction_lats,
+            construction_lons,
+            existing_lats,
+            existing_lons,
+            build_threshold=build_threshold
+        )
+
+    folium.LayerControl(collapsed=False).add_to(m)
+    m.save(map_path)
+
+    return map_path
@@ -0,0 +1,187 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+# the profiler the timed/count_event/stage/profile_company helpers report to, None when profiling is off
+_active_profiler = None
+
+# returned by the helpers when profiling is off, so instrumented code only pays for a function call
+_NULL_CONTEXT = nullcontext()
+
+
+def get_max_rss_mb():
+    """
+        peak resident memory of the process in MB, None when it cannot be measured on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        # resource is unix only, on windows use psutil if it is installed
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / 2 ** 20
+
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+class Profiler:
+    """
+        timers and counters for the pipeline (see the timed, count_event, stage and profile_company helpers).
+        Stages record their wall time and the growth of the peak memory of the process, timers
+        accumulate the time and calls of the inner loop helpers, counters accumulate events
+
+        companies listed in 'profile_companies' are run under cProfile, and the stats are written to
+        profile_<company>.prof when the report is written. 'company_hook' can attach any other
+        profiler: it is called with the company name and returns a context manager (or None) that
+        is entered around every step of that company, e.g. one starting a sampling profiler
+
+        everything is collected in the current process, worker processes (workers > 1) are not profiled
+    """
+
+    def __init__(self, profile_companies=None, company_hook=None):
+        self.stages = {}
+        self.timers = {}
+        self.counters = Counter()
+        self.profile_companies = set(profile_companies or [])
+        self.company_hook = company_hook
+        self.company_profiles = {}
+
+    def activate(self):
+        """
+            make this the profiler the helpers report to
+        """
+        global _active_profiler
+        _active_profiler = self
+
+        return self
+
+    def deactivate(self):
+        global _active_profiler
+        if _active_profiler is self:
+            _active_profiler = None
+
+    @contextmanager
+    def stage(self, name):
+        start_rss_mb = get_max_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'max_rss_mb': None, 'rss_growth_mb': None})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            stage['max_rss_mb'] = get_max_rss_mb()
+            if stage['max_rss_mb'] is not None:
+                stage['rss_growth_mb'] = (stage['rss_growth_mb'] or 0.0) + stage['max_rss_mb'] - start_rss_mb
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += time.perf_counter() - start
+            timer[1] += 1
+
+    @contextmanager
+    def company(self, company_name):
+        hook_context = self.company_hook(company_name) if self.company_hook is not None else None
+        with hook_context if hook_context is not None else _NULL_CONTEXT:
+            if company_name not in self.profile_companies:
+                yield
+                return
+
+            # one cProfile per company, enabled around every step of the company so the stats add up
+            company_profile = self.company_profiles.setdefault(company_name, cProfile.Profile())
+            company_profile.enable()
+            try:
+                yield
+            finally:
+                company_profile.disable()
+
+    def get_report(self):
+        return {
+            'stages': self.stages,
+            'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in self.timers.items()},
+            'counters': dict(self.counters),
+            'max_rss_mb': get_max_rss_mb()
+        }
+
+    def write_report(self, fname="./profile_report.json", top_functions=20):
+        """
+            write the report to 'fname', log it, and write the cProfile stats of the profiled companies
+        """
+        report = self.get_report()
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=4)
+
+        logger.info(f"{'stage':<24}{'seconds':>10}{'calls':>8}{'max rss mb':>12}{'growth mb':>11}")
+        for name, stage in report['stages'].items():
+            # memory is None where the platform cannot measure it
+            max_rss = '-' if stage['max_rss_mb'] is None else f"{stage['max_rss_mb']:.1f}"
+            rss_growth = '-' if stage['rss_growth_mb'] is None else f"{stage['rss_growth_mb']:.1f}"
+            logger.info(f"{name:<24}{stage['seconds']:>10.3f}{stage['calls']:>8}{max_rss:>12}{rss_growth:>11}")
+        for name, timer in report['timers'].items():
+            logger.info(f"timer {name}: {timer['seconds']:.3f} s over {timer['calls']} calls")
+        logger.info("counters: " + ", ".join(f"{name} {count}" for name, count in report['counters'].items()))
+
+        for company_name, company_profile in self.company_profiles.items():
+            profile_fname = f"./profile_{company_name}.prof"
+            company_profile.dump_stats(profile_fname)
+
+            stats_stream = io.StringIO()
+            pstats.Stats(company_profile, stream=stats_stream).sort_stats('cumulative').print_stats(top_functions)
+            logger.info(f"cProfile of {company_name} written to {profile_fname}\n{stats_stream.getvalue()}")
+
+        logger.info(f"wrote to {fname}")
+
+        return report
+
+
+def timed(name):
+    """
+        accumulate the time spent in the block under 'name' when profiling is on
+    """
+    if _active_profiler is None:
+        return _NULL_CONTEXT
+    return _active_profiler.timer(name)
+
+
+def count_event(name, num=1):
+    """
+        add 'num' to the counter 'name' when profiling is on
+    """
+    if _active_profiler is not None:
+        _active_profiler.counters[name] += num
+
+
+def stage(name):
+    """
+        record the block as the pipeline stage 'name' when profiling is on
+    """
+    if _active_profiler is None:
+        return _NULL_CONTEXT
+    return _active_profiler.stage(name)
+
+
+def profile_company(company_name):
+    """
+        run the block under the profilers attached to 'company_name' when profiling is on
+    """
+    if _active_profiler is None:
+        return _NULL_CONTEXT
+    return _active_profiler.company(company_name)
@@ -0,0 +1,147 @@
+import numpy as np
+
+# one row per interference. Coordinates are stored once per site (see CompanyInterferences),
+# so a row is 22 bytes instead of a "lat,lon:units:dist" string inside nested dicts
+INTERFERENCE_DTYPE = np.dtype([
+    ('construction_idx', np.int32),  # position of the construction site in the company's construction frame
+    ('existing_idx', np.int32),  # position of the existing site in CompanyInterferences.existing_lats/lons
+    ('city_id', np.int16),  # position of the closest metro in CompanyInterferences.city_names
+    ('distance', np.float64),  # distance between the construction and existing site in miles
+    ('units', np.int32)  # units in progress at the construction site
+])
+
+
+def get_str_from_coord(lat, lon):
+    return ",".join([str(lat), str(lon)])
+
+
+class CompanyInterferences:
+    """
+        the analysis results of one company as a columnar interference table plus the coordinates
+        of the sites the table points into. The summary statistics and the legacy JSON layout
+        (to_json_dict) are derived from the table
+
+        counted_sites holds the positions of the construction sites whose units were counted, in
+        the order they were counted
+
+        the cross company results of run(variant='total') also know which company every site
+        belongs to (see set_site_companies)
+    """
+
+    def __init__(self,
+                 company_name,
+                 city_names,
+                 construction_lats,
+                 construction_lons,
+                 construction_units,
+                 existing_lats,
+                 existing_lons,
+                 interferences,
+                 counted_sites):
+        self.company_name = company_name
+        self.city_names = list(city_names)
+        self.construction_lats = np.asarray(construction_lats, dtype=np.float64)
+        self.construction_lons = np.asarray(construction_lons, dtype=np.float64)
+        self.construction_units = np.asarray(construction_units, dtype=np.float64)
+        self.existing_lats = np.asarray(existing_lats, dtype=np.float64)
+        self.existing_lons = np.asarray(existing_lons, dtype=np.float64)
+        self.interferences = np.asarray(interferences, dtype=INTERFERENCE_DTYPE)
+        self.counted_sites = np.asarray(counted_sites, dtype=np.int64)
+
+        # owners of the sites, positions in company_names. None for the results of a single company
+        self.company_names = None
+        self.construction_company_ids = None
+        self.existing_company_ids = None
+
+    def __len__(self):
+        return len(self.interferences)
+
+    def set_site_companies(self, company_names, construction_company_ids, existing_company_ids):
+        """
+            record the company of every construction and existing site (positions in company_names)
+        """
+        self.company_names = list(company_names)
+        self.construction_company_ids = np.asarray(construction_company_ids, dtype=np.int64)
+        self.existing_company_ids = np.asarray(existing_company_ids, dtype=np.int64)
+
+    def get_interference_counts_by_company(self):
+        """
+            (companies x companies) matrix of interference counts, rows are the companies building
+            and columns the companies owning the existing sites. Only for cross company results
+        """
+        assert self.company_names is not None, "the sites have no companies, see set_site_companies"
+
+        num_companies = len(self.company_names)
+        pair_ids = (
+            self.construction_company_ids[self.interferences['construction_idx']] * num_companies
+            + self.existing_company_ids[self.interferences['existing_idx']]
+        )
+
+        return np.bincount(pair_ids, minlength=num_companies * num_companies).reshape(num_companies, num_companies)
+
+    @property
+    def total_interferences(self):
+        return len(self.interferences)
+
+    def get_distances(self):
+        """
+            contiguous array of all interference distances in the order they were found
+        """
+        return np.ascontiguousarray(self.interferences['distance'])
+
+    def get_interference_counts_by_city(self):
+        """
+            number of interferences per metro, in the order of city_names
+        """
+        return np.bincount(self.interferences['city_id'], minlength=len(self.city_names))
+
+    def get_units_wip_by_city(self):
+        """
+            units in progress per metro, in the order of city_names. The units of a construction
+            site count towards the city of its first interference only
+        """
+        units_wip_by_city = np.zeros(len(self.city_names), dtype=np.int64)
+
+        first_rows = np.unique(self.interferences['construction_idx'], return_index=True)[1]
+        np.add.at(units_wip_by_city, self.interferences['city_id'][first_rows], self.interferences['units'][first_rows])
+
+        return units_wip_by_city
+
+    def get_total_units_wip(self):
+        # summed one site at a time in counting order, so the float total matches the legacy results exactly
+        total_units_wip = 0
+        for units in self.construction_units[self.counted_sites]:
+            total_units_wip += float(units)
+
+        return total_units_wip
+
+    def to_json_dict(self):
+        """
+            the results in the legacy nested dictionary layout written to the json files:
+            interferences are "elat,elon:units:dist" strings grouped by city and construction site
+        """
+        construction_keys = [
+            get_str_from_coord(lat, lon) for lat, lon in zip(self.construction_lats.tolist(), self.construction_lons.tolist())
+        ]
+
+        # every construction coordinate appears once, True when a site at that coordinate was counted
+        construction_sites_counted = dict.fromkeys(construction_keys, False)
+        for cxn_idx in self.counted_sites.tolist():
+            construction_sites_counted[construction_keys[cxn_idx]] = True
+
+        interferences_by_city = {city_name: {} for city_name in self.city_names}
+        existing_lats = self.existing_lats.tolist()
+        existing_lons = self.existing_lons.tolist()
+        for cxn_idx, exst_idx, city_id, distance, units in self.interferences.tolist():
+            entry_str = ":".join([get_str_from_coord(existing_lats[exst_idx], existing_lons[exst_idx]), str(units), str(distance)])
+            interferences_by_city[self.city_names[city_id]].setdefault(construction_keys[cxn_idx], []).append(entry_str)
+
+        return {
+            'total_company_interferences': self.total_interferences,
+            'construction_sites_counted': construction_sites_counted,
+            'units_wip_by_city': dict(zip(self.city_names, self.get_units_wip_by_city().tolist())),
+            'interferences_by_city': interferences_by_city,
+            'all_distances': self.interferences['distance'].tolist(),
+            'interference_count_by_city': dict(zip(self.city_names, self.get_interference_counts_by_city().tolist())),
+            'total_units_wip': self.get_total_units_wip()
+        }
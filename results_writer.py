@@ -0,0 +1,139 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    # optional, the standard library json module writes the same documents, only slower
+    orjson = None
+
+RESULTS_FORMATS = ['pretty', 'compact', 'ndjson']
+
+# interferences converted and written per block so the ndjson writer never holds a whole company in memory
+NDJSON_BLOCK_SIZE = 65536
+
+
+def dumps_json(obj, results_format='compact'):
+    """
+        the json document of 'obj' as bytes. 'pretty' is the original layout (json, indent of 4),
+        'compact' has no whitespace and uses orjson when it is installed
+    """
+    if results_format == 'pretty':
+        return json.dumps(obj, indent=4).encode()
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def write_json_results(all_company_analysis_results, companies_dir="./companies", all_results_path="./all_analysis_results.json", results_format='pretty'):
+    """
+        write the legacy nested layout (CompanyInterferences.to_json_dict) of every company to
+        <companies_dir>/<company>_analysis_results.json and of all companies to all_results_path
+
+        only one company is converted at a time. Its document is written to its own file and
+        spliced into the combined file, so the combined dictionary is never built in memory
+    """
+    written_paths = []
+
+    with open(all_results_path, 'wb') as all_f:
+        all_f.write(b"{")
+        for company_idx, (company, company_results) in enumerate(all_company_analysis_results.items()):
+            company_json = dumps_json(company_results.to_json_dict(), results_format)
+
+            fname = os.path.join(companies_dir, f"{company}_analysis_results.json")
+            with open(fname, 'wb') as f:
+                f.write(company_json)
+            written_paths.append(fname)
+
+            key_json = dumps_json(company, results_format)
+            if results_format == 'pretty':
+                # json.dump(..., indent=4) of the combined dictionary nests every company one level deeper
+                separator = b"," if company_idx else b""
+                all_f.write(separator + b"\n    " + key_json + b": " + company_json.replace(b"\n", b"\n    "))
+            else:
+                all_f.write((b"," if company_idx else b"") + key_json + b":" + company_json)
+
+        if results_format == 'pretty' and all_company_analysis_results:
+            all_f.write(b"\n")
+        all_f.write(b"}")
+    written_paths.append(all_results_path)
+
+    return written_paths
+
+
+def iter_interference_records(company, company_results, block_size=NDJSON_BLOCK_SIZE):
+    """
+        one dictionary per interference of the company, converted from the table a block at a time
+    """
+    city_names = company_results.city_names
+    construction_lats = company_results.construction_lats
+    construction_lons = company_results.construction_lons
+    existing_lats = company_results.existing_lats
+    existing_lons = company_results.existing_lons
+
+    for start in range(0, len(company_results.interferences), block_size):
+        block = company_results.interferences[start:start + block_size]
+        cxn_idxs = block['construction_idx']
+        exst_idxs = block['existing_idx']
+
+        for c_lat, c_lon, e_lat, e_lon, city_id, distance, units in zip(
+                construction_lats[cxn_idxs].tolist(),
+                construction_lons[cxn_idxs].tolist(),
+                existing_lats[exst_idxs].tolist(),
+                existing_lons[exst_idxs].tolist(),
+                block['city_id'].tolist(),
+                block['distance'].tolist(),
+                block['units'].tolist()):
+            yield {
+                'type': 'interference',
+                'company': company,
+                'city': city_names[city_id],
+                'construction_lat': c_lat,
+                'construction_lon': c_lon,
+                'existing_lat': e_lat,
+                'existing_lon': e_lon,
+                'units': units,
+                'distance': distance
+            }
+
+
+def get_company_summary_record(company, company_results):
+    """
+        the per company totals of the legacy layout, everything except the individual interferences
+    """
+    return {
+        'type': 'company',
+        'company': company,
+        'total_company_interferences': company_results.total_interferences,
+        'total_units_wip': company_results.get_total_units_wip(),
+        'units_wip_by_city': dict(zip(company_results.city_names, company_results.get_units_wip_by_city().tolist())),
+        'interference_count_by_city': dict(zip(company_results.city_names, company_results.get_interference_counts_by_city().tolist()))
+    }
+
+
+def write_ndjson_results(all_company_analysis_results, path="./all_analysis_results.ndjson", block_size=NDJSON_BLOCK_SIZE):
+    """
+        write every interference as one json object per line ("type": "interference"), followed by a
+        "type": "company" line with the totals of each company. Lines are written as they are
+        converted, so memory does not grow with the number of interferences
+    """
+    with open(path, 'wb') as f:
+        for company, company_results in all_company_analysis_results.items():
+            for record in iter_interference_records(company, company_results, block_size=block_size):
+                f.write(dumps_json(record) + b"\n")
+            f.write(dumps_json(get_company_summary_record(company, company_results)) + b"\n")
+
+    return [path]
+
+
+def iter_ndjson_results(path):
+    """
+        read a file written by write_ndjson_results one record at a time
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
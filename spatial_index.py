@@ -0,0 +1,280 @@
+import numpy as np
+
+from distance_engine import paired_distances
+from profiling import count_event
+
+# smallest radius of curvature of the WGS-84 ellipsoid (at the equator, along the meridian) in miles.
+# converting a distance to an angle with it can only overestimate the angle, so searches stay conservative
+MIN_EARTH_RADIUS_MI = 6335.439 / 1.609344
+
+# extra room on top of the conservative angle for floating point and sphere vs ellipsoid differences
+SEARCH_MARGIN = 1.01
+
+
+def get_paired_distances(distance_cache=None):
+    """
+        the paired_distances function to use, memoized by the distance cache when there is one
+    """
+    return paired_distances if distance_cache is None else distance_cache.paired_distances
+
+
+def get_search_window(lat, radius_mi):
+    """
+        latitude and longitude half widths (degrees) of a box around a point at 'lat' that contains
+        every location within 'radius_mi' miles. The longitude half width is None when the box
+        touches a pole, meaning every longitude has to be searched
+    """
+    ang = SEARCH_MARGIN * radius_mi / MIN_EARTH_RADIUS_MI
+    dlat = np.degrees(ang)
+
+    if abs(lat) + dlat >= 90 or ang >= np.pi / 2:
+        return dlat, None
+
+    # widest longitude difference of a point at angular distance 'ang' (sphere)
+    sin_ratio = np.sin(ang) / np.cos(np.radians(abs(lat) + dlat))
+    if sin_ratio >= 1:
+        return dlat, None
+
+    return dlat, np.degrees(np.arcsin(sin_ratio))
+
+
+class SpatialGridIndex:
+    """
+        geohash style grid index over a set of points. Every point is put into a lat/lon cell of
+        'cell_size_mi' miles (measured along the meridian) and radius queries only look at the cells
+        overlapping the search window, so a query costs the number of nearby points instead of all points
+
+        the exact distance filter uses the distance engine, so query results match a brute force
+        comparison with the same distance mode
+    """
+
+    def __init__(self, lats, lons, cell_size_mi=1.0):
+        self.lats = np.asarray(lats, dtype=np.float64).ravel()
+        self.lons = np.asarray(lons, dtype=np.float64).ravel()
+
+        # pick a cell size that divides the globe evenly so longitudes wrap around at +/-180
+        desired_cell_deg = np.degrees(max(cell_size_mi, 0.1) / MIN_EARTH_RADIUS_MI)
+        self.num_lon_cells = int(np.ceil(360 / desired_cell_deg))
+        self.cell_deg = 360 / self.num_lon_cells
+
+        lat_cells = self._lat_cell(self.lats)
+        lon_cells = self._lon_cell(self.lons)
+
+        # group the point indices by cell, keeping ascending order inside each cell
+        self.cells = {}
+        if len(self.lats):
+            order = np.lexsort((np.arange(len(self.lats)), lon_cells, lat_cells))
+            keys = np.stack([lat_cells[order], lon_cells[order]], axis=1)
+            split_at = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+            for cell_idxs in np.split(order, split_at):
+                self.cells[(int(lat_cells[cell_idxs[0]]), int(lon_cells[cell_idxs[0]]))] = cell_idxs
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _lat_cell(self, lats):
+        return np.floor((np.asarray(lats) + 90) / self.cell_deg).astype(np.int64)
+
+    def _lon_cell(self, lons):
+        # normalize to [-180, 180) first so every longitude lands in one of the num_lon_cells cells
+        lons = np.mod(np.asarray(lons) + 180, 360)
+        return np.floor(lons / self.cell_deg).astype(np.int64) % self.num_lon_cells
+
+    def candidates(self, lat, lon, radius_mi):
+        """
+            sorted indices of the points in the cells overlapping the search window around (lat, lon).
+            a superset of the points within 'radius_mi', no distances are computed
+        """
+        dlat, dlon = get_search_window(lat, radius_mi)
+
+        # only the latitude cells that exist, from the south pole to the north pole
+        lat_cell_lo, lat_cell_hi = self._lat_cell([max(lat - dlat, -90), min(lat + dlat, 90)])
+
+        if dlon is None or 2 * dlon >= 360 - 2 * self.cell_deg:
+            lon_cells = range(self.num_lon_cells)
+        else:
+            lon_cell_lo = int(np.floor((lon - dlon + 180) / self.cell_deg))
+            lon_cell_hi = int(np.floor((lon + dlon + 180) / self.cell_deg))
+            lon_cells = [c % self.num_lon_cells for c in range(lon_cell_lo, lon_cell_hi + 1)]
+
+        found = []
+        if (lat_cell_hi - lat_cell_lo + 1) * len(lon_cells) > len(self.cells):
+            # a wide window has more cells than there are occupied ones, check the occupied cells instead
+            lon_cells = set(lon_cells)
+            for (lat_cell, lon_cell), cell_idxs in self.cells.items():
+                if lat_cell_lo <= lat_cell <= lat_cell_hi and lon_cell in lon_cells:
+                    found.append(cell_idxs)
+        else:
+            for lat_cell in range(lat_cell_lo, lat_cell_hi + 1):
+                for lon_cell in lon_cells:
+                    cell_idxs = self.cells.get((lat_cell, lon_cell))
+                    if cell_idxs is not None:
+                        found.append(cell_idxs)
+
+        if not found:
+            return np.empty(0, dtype=np.int64)
+
+        return np.sort(np.concatenate(found))
+
+    def query_radius(self, lat, lon, radius_mi, distance_mode='geodesic', distance_cache=None):
+        """
+            all points within 'radius_mi' miles of (lat, lon)
+
+            returns the ascending point indices and the matching distances in miles, measured
+            from the indexed point to (lat, lon). Distances are memoized in 'distance_cache' if given
+        """
+        candidate_idxs = self.candidates(lat, lon, radius_mi)
+        count_event('pairs_grid_candidates', len(candidate_idxs))
+
+        # the cells overlapping the window hold many points outside of it, a box test is much
+        # cheaper than a distance and only removes points that cannot be within radius_mi
+        in_window_idxs = candidate_idxs[self.within_window(candidate_idxs, lat, lon, radius_mi)]
+        count_event('pairs_removed_by_bbox', len(candidate_idxs) - len(in_window_idxs))
+        candidate_idxs = in_window_idxs
+
+        distances = get_paired_distances(distance_cache)(
+            self.lats[candidate_idxs],
+            self.lons[candidate_idxs],
+            lat,
+            lon,
+            mode=distance_mode
+        )
+        within = distances <= radius_mi
+        count_event('pairs_removed_by_distance', len(candidate_idxs) - int(np.count_nonzero(within)))
+
+        return candidate_idxs[within], distances[within]
+
+    def within_window(self, idxs, lat, lon, radius_mi):
+        """
+            mask of the points 'idxs' inside the search window around (lat, lon), the latitude and
+            longitude box holding every location within 'radius_mi' (see get_search_window)
+        """
+        dlat, dlon = get_search_window(lat, radius_mi)
+
+        within = np.abs(self.lats[idxs] - lat) <= dlat
+        if dlon is not None:
+            # longitude difference wrapped to [-180, 180)
+            within &= np.abs(np.mod(self.lons[idxs] - lon + 180, 360) - 180) <= dlon
+
+        return within
+
+
+def get_unit_vectors(lats, lons):
+    """
+        (N, 3) array of points on the unit sphere for the given latitudes and longitudes (degrees)
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64).ravel())
+    lons = np.radians(np.asarray(lons, dtype=np.float64).ravel())
+
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=1)
+
+
+class MetroLookup:
+    """
+        nearest metro lookup built once from the metro coordinates (see get_metro_coords_dict).
+
+        the metros are stored as unit vectors, so ranking every metro for a whole batch of points is a
+        single (N, 3) x (3, M) product. Ellipsoidal distances differ from spherical ones by well under
+        1%, so only the metros within that margin of the spherically closest one are measured exactly
+        with the distance engine. The result is the same closest city and distance that measuring
+        every metro (get_city_from_coords) gives, including ties going to the first metro in the file
+    """
+
+    # relative difference between spherical and ellipsoidal distances is below ~0.6%
+    SPHERE_ERROR = 0.01
+
+    def __init__(self, metro_coords):
+        self.cities = list(metro_coords.keys())
+        self.lats = np.array([coords[0] for coords in metro_coords.values()], dtype=np.float64)
+        self.lons = np.array([coords[1] for coords in metro_coords.values()], dtype=np.float64)
+        self.unit_vectors = get_unit_vectors(self.lats, self.lons)
+
+    def __len__(self):
+        return len(self.cities)
+
+    def nearest_ids(self, test_lats, test_lons, distance_mode='geodesic', distance_cache=None):
+        """
+            closest metro for every test location. returns an array of distances in miles
+            and an array of metro indices (positions in self.cities)
+
+            the exact distances are memoized in 'distance_cache' (see distance_cache.py) if given
+        """
+        test_lats = np.asarray(test_lats, dtype=np.float64).ravel()
+        test_lons = np.asarray(test_lons, dtype=np.float64).ravel()
+
+        if len(test_lats) == 0:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        # central angle to every metro from the dot products of the unit vectors
+        cos_angles = np.clip(get_unit_vectors(test_lats, test_lons) @ self.unit_vectors.T, -1.0, 1.0)
+        angles = np.arccos(cos_angles)
+
+        # every metro that could still be the closest once the distances are measured on the ellipsoid.
+        # the small absolute slack covers the limited precision of arccos for nearly parallel vectors
+        max_angles = angles.min(axis=1, keepdims=True) * (1 + self.SPHERE_ERROR) / (1 - self.SPHERE_ERROR) + 1e-6
+        row_idxs, metro_idxs = np.nonzero(angles <= max_angles)
+
+        dists = np.full(angles.shape, np.inf)
+        dists[row_idxs, metro_idxs] = get_paired_distances(distance_cache)(
+            test_lats[row_idxs],
+            test_lons[row_idxs],
+            self.lats[metro_idxs],
+            self.lons[metro_idxs],
+            mode=distance_mode
+        )
+
+        min_idxs = np.argmin(dists, axis=1)
+        min_dists = dists[np.arange(len(min_idxs)), min_idxs]
+
+        return min_dists, min_idxs
+
+    def lower_bound_distances(self, test_lats, test_lons):
+        """
+            a lower bound in miles of the distance from every test location to its closest metro, in
+            any distance mode. Only the angles between the unit vectors are used, no distance is measured
+        """
+        test_lats = np.asarray(test_lats, dtype=np.float64).ravel()
+        test_lons = np.asarray(test_lons, dtype=np.float64).ravel()
+
+        if len(test_lats) == 0 or len(self) == 0:
+            return np.full(len(test_lats), np.inf)
+
+        cos_angles = np.clip(get_unit_vectors(test_lats, test_lons) @ self.unit_vectors.T, -1.0, 1.0)
+
+        # the angle between the normals of two points is at most their distance over the smallest
+        # radius of curvature, which makes the distance at least the angle times that radius
+        return np.arccos(cos_angles).min(axis=1) * MIN_EARTH_RADIUS_MI / SEARCH_MARGIN
+
+    def may_be_counted(self, lats, lons, build_threshold, city_threshold):
+        """
+            mask of the sites that can be part of a pair passing the city_threshold rule, i.e. a pair
+            within build_threshold whose midpoint (the average of the coordinates) has its closest metro
+            within city_threshold. The midpoint is about half the pair distance away from either site,
+            so a site farther than city_threshold + build_threshold from every metro can never be part
+            of such a pair and is left out
+
+            sites whose build_threshold window reaches a pole or the antimeridian are always kept,
+            averaging the coordinates of a pair across them can put the midpoint far from both sites
+        """
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+
+        ang = SEARCH_MARGIN * build_threshold / MIN_EARTH_RADIUS_MI
+        dlat = np.degrees(ang)
+
+        # widest longitude difference within build_threshold, as in get_search_window
+        edge_lats = np.minimum(np.abs(lats) + dlat, 90)
+        sin_ratios = np.sin(ang) / np.maximum(np.cos(np.radians(edge_lats)), 1e-12)
+        dlons = np.degrees(np.arcsin(np.minimum(sin_ratios, 1.0)))
+        wraps = (edge_lats >= 90) | (sin_ratios >= 1) | (np.abs(lons) + dlons >= 180)
+
+        return wraps | (self.lower_bound_distances(lats, lons) <= city_threshold + build_threshold)
+
+    def nearest(self, test_lats, test_lons, distance_mode='geodesic', distance_cache=None):
+        """
+            closest metro for every test location. returns an array of distances in miles
+            and a list of city names
+        """
+        min_dists, min_idxs = self.nearest_ids(test_lats, test_lons, distance_mode=distance_mode, distance_cache=distance_cache)
+
+        return min_dists, [self.cities[min_idx] for min_idx in min_idxs]
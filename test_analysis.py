@@ -0,0 +1,154 @@
+"""
+    checks of the search shortcuts against brute force on small synthetic portfolios
+
+    python -m pytest -q
+"""
+import numpy as np
+import pandas as pd
+
+import driver
+from distance_engine import paired_distances
+from spatial_index import MetroLookup, SpatialGridIndex
+
+KEYS = ('ELat', 'ELon', 'CLat', 'CLon', 'num units')
+
+# a few metros plus ones next to the antimeridian and the north pole, where the search windows wrap
+METRO_COORDS_DICT = {
+    'New York': [40.7128, -74.0060],
+    'Denver': [39.7392, -104.9903],
+    'Fiji': [-17.7, 179.9],
+    'Longyearbyen': [78.2, 15.6],
+    'Nome': [64.5, -165.4]
+}
+
+
+def get_sites(rng, num_sites, spread_deg=0.3):
+    """
+        sites scattered around the metros, across the antimeridian, near the pole and anywhere
+    """
+    metro_coords = np.array(list(METRO_COORDS_DICT.values()))
+    around = metro_coords[rng.integers(len(metro_coords), size=num_sites)] + rng.normal(0, spread_deg, (num_sites, 2))
+    antimeridian = np.stack([rng.uniform(-18.5, -17, num_sites // 4), rng.choice([-1, 1], num_sites // 4) * rng.uniform(179.5, 180, num_sites // 4)], axis=1)
+    polar = np.stack([rng.uniform(88.5, 90, num_sites // 4), rng.uniform(-180, 180, num_sites // 4)], axis=1)
+    anywhere = np.stack([rng.uniform(-60, 70, num_sites // 4), rng.uniform(-180, 180, num_sites // 4)], axis=1)
+
+    sites = np.concatenate([around, antimeridian, polar, anywhere])
+    sites[:, 0] = np.clip(sites[:, 0], -90, 90)
+    sites[:, 1] = np.mod(sites[:, 1] + 180, 360) - 180
+
+    return sites[:, 0], sites[:, 1]
+
+
+def get_portfolio(seed=0, num_companies=2, num_sites=200):
+    rng = np.random.default_rng(seed)
+
+    company_property_dict = {}
+    for company_idx in range(num_companies):
+        construction_lats, construction_lons = get_sites(rng, num_sites)
+        existing_lats, existing_lons = get_sites(rng, num_sites)
+        company_property_dict[f"Company {company_idx}"] = {
+            'construction': pd.DataFrame({
+                'CLat': construction_lats,
+                'CLon': construction_lons,
+                'num units': rng.integers(1, 100, len(construction_lats))
+            }),
+            'existing': pd.DataFrame({'ELat': existing_lats, 'ELon': existing_lons})
+        }
+
+    return company_property_dict
+
+
+def test_query_radius_matches_brute_force():
+    lats, lons = get_sites(np.random.default_rng(1), 400)
+    index = SpatialGridIndex(lats, lons, cell_size_mi=3)
+
+    queries = [(40.5, -74.2, 30), (89.9, 20, 50), (-89, 0, 300), (-17.7, 179.99, 40), (-17.7, -179.99, 40), (10, -100, 4000)]
+    for distance_mode in ['haversine', 'vincenty']:
+        for lat, lon, radius_mi in queries:
+            idxs, distances = index.query_radius(lat, lon, radius_mi, distance_mode=distance_mode)
+
+            brute_distances = paired_distances(lats, lons, lat, lon, mode=distance_mode)
+            brute_idxs = np.flatnonzero(brute_distances <= radius_mi)
+
+            assert np.array_equal(idxs, brute_idxs)
+            assert np.array_equal(distances, brute_distances[brute_idxs])
+
+
+def test_metro_lower_bound():
+    lats, lons = get_sites(np.random.default_rng(2), 400)
+    metro_lookup = MetroLookup(METRO_COORDS_DICT)
+
+    lower_bounds = metro_lookup.lower_bound_distances(lats, lons)
+    for distance_mode in ['haversine', 'vincenty']:
+        assert np.all(lower_bounds <= metro_lookup.nearest_ids(lats, lons, distance_mode=distance_mode)[0])
+
+
+def test_metro_prefilter_keeps_counted_pairs():
+    company_site_arrays = driver.get_company_site_arrays(get_portfolio(seed=3, num_companies=1, num_sites=400), *KEYS)
+    site_arrays = company_site_arrays['Company 0']
+
+    for distance_mode, build_threshold, city_threshold in [('haversine', 20, 30), ('vincenty', 60, 150)]:
+        tables = []
+        for prefilter_city_threshold in [None, city_threshold]:
+            site_matches = driver.search_construction_sites(
+                site_arrays['construction_lats'],
+                site_arrays['construction_lons'],
+                site_arrays['existing_lats'],
+                site_arrays['existing_lons'],
+                METRO_COORDS_DICT,
+                build_threshold,
+                distance_mode,
+                city_threshold=prefilter_city_threshold
+            )
+            tables.append(driver.count_company_interferences(
+                'Company 0',
+                site_arrays['construction_lats'],
+                site_arrays['construction_lons'],
+                site_arrays['construction_units'],
+                site_arrays['existing_lats'],
+                site_arrays['existing_lons'],
+                site_matches,
+                METRO_COORDS_DICT,
+                build_threshold=build_threshold,
+                city_threshold=city_threshold,
+                trace_every=0
+            ).to_json_dict())
+
+        # the prefilter has to leave out some sites for the comparison to mean anything
+        assert not MetroLookup(METRO_COORDS_DICT).may_be_counted(
+            site_arrays['construction_lats'], site_arrays['construction_lons'], build_threshold, city_threshold).all()
+        assert tables[0]['total_company_interferences'] > 0
+        assert tables[0] == tables[1]
+
+
+def get_tables(all_company_analysis_results):
+    return {company: company_results.to_json_dict() for company, company_results in all_company_analysis_results.items()}
+
+
+def test_incremental_matches_full_run(tmp_path):
+    company_property_dict = get_portfolio(seed=4)
+    state_path = str(tmp_path / "incremental_state.npz")
+    thresholds = {'build_threshold': 20, 'city_threshold': 50, 'distance_mode': 'haversine', 'trace_every': 0}
+
+    first_results = driver.run_incremental(company_property_dict, METRO_COORDS_DICT, *KEYS, state_path, **thresholds)
+    assert get_tables(first_results) == get_tables(driver.run(company_property_dict, METRO_COORDS_DICT, *KEYS, **thresholds))
+
+    # add, move and remove construction and existing sites of every company
+    rng = np.random.default_rng(5)
+    changed_property_dict = {}
+    for company, frames in company_property_dict.items():
+        changed_frames = {}
+        for frame_name, lat_key, lon_key in [('construction', 'CLat', 'CLon'), ('existing', 'ELat', 'ELon')]:
+            df = frames[frame_name].iloc[10:].copy()
+            df.iloc[:10, df.columns.get_loc(lat_key)] += rng.normal(0, 0.1, 10)
+            df.iloc[:10, df.columns.get_loc(lon_key)] += rng.normal(0, 0.1, 10)
+            added = frames[frame_name].iloc[20:30].copy()
+            added[lat_key] += rng.normal(0, 0.1, 10)
+            changed_frames[frame_name] = pd.concat([df, added], ignore_index=True)
+        changed_property_dict[company] = changed_frames
+
+    incremental_results = driver.run_incremental(changed_property_dict, METRO_COORDS_DICT, *KEYS, state_path, **thresholds)
+    full_results = driver.run(changed_property_dict, METRO_COORDS_DICT, *KEYS, **thresholds)
+
+    assert sum(company_results.total_interferences for company_results in full_results.values()) > 0
+    assert get_tables(incremental_results) == get_tables(full_results)